@@ -21,29 +21,46 @@
 
 
 
+# Write a file to receiver memory.
+
 import ubx
-import struct
-import calendar
-import os
 import gobject
 import logging
 import sys
-import socket
 import time
 
-d = {}
-
 loop = gobject.MainLoop()
-start = int(sys.argv[1])
-val = ord(sys.stdin.read()[0])
-
-def callback(ty, *args):
-    print("callback %s %s" % (ty, repr(args)))
-    if ty == "UPD-DOWNL":
-        assert args[0][0]["Flags"] == 1
-        loop.quit()
-        
+
+def cbDone(write):
+    elapsed = max(time.time() - write.started, 1e-9)
+    print("%d bytes in %.1f s, %.0f bytes/s, chunk %d" % (write.bytes, elapsed, write.rate(), write.chunk))
+    for (address, size) in write.failed:
+        print("failed to write %d bytes at 0x%x" % (size, address))
+    for (address, size) in write.mismatches:
+        print("%d bytes at 0x%x differ after writing" % (size, address))
+    loop.quit()
+
 if __name__ == "__main__":
-    t = ubx.Parser(callback)
-    t.send("UPD-DOWNL", 8 + 1, {"StartAddr" : start, "Flags" : 0, "B0" : val})
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a file to receiver memory with UPD-DOWNL.")
+    parser.add_argument('start', type=lambda x: int(x, 0), help='First address')
+    parser.add_argument('filename', nargs='?', help='Data to write, default stdin')
+    parser.add_argument('--device', '-d', default='/dev/ttyACM0')
+    parser.add_argument('--chunk', type=int, default=512, help='Bytes per request, halved until the receiver answers')
+    parser.add_argument('--window', type=int, default=4, help='Requests in flight')
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--verify', action='store_true', help='Read the written range back and compare')
+    args = parser.parse_args()
+
+    if args.filename:
+        with open(args.filename, 'rb') as f:
+            data = f.read()
+    else:
+        data = getattr(sys.stdin, 'buffer', sys.stdin).read()
+    t = ubx.Parser(None, device=args.device)
+    write = ubx.MemoryWrite(t, args.start, data, args.chunk, args.window, args.timeout, args.retries,
+                            args.verify, cbDone)
+    write.run()
     loop.run()
+    sys.exit(1 if write.failed or write.mismatches else 0)
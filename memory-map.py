@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Map the readable regions of receiver memory.
+
+import ubx
+import gobject
+import logging
+import sys
+import time
+
+loop = gobject.MainLoop()
+
+# Periodic messages that would compete with the probes for the link
+PERIODIC = ["NAV-STATUS", "NAV-POSLLH", "NAV-VELNED", "NAV-TIMEUTC", "NAV-DOP", "NAV-SVINFO"]
+
+def cbPorts(request):
+    if request.status != "reply":
+        sys.exit("polling CFG-PRT failed: %s" % request.status)
+    ports = request.data
+    # only UBX
+    ports[1]["Out_proto_mask"] = 1
+    messages = [("CFG-PRT", 20, ports)]
+    messages += [("CFG-MSG", 3, [{"msgClass": ubx.CLIDPAIR[clid][0], "msgId": ubx.CLIDPAIR[clid][1]}, {"rate": 0}])
+                 for clid in PERIODIC]
+    t.configure(messages, cbSilenced)
+
+def cbSilenced(transaction):
+    for request in transaction.failed():
+        logging.warning("%s: %s" % (request.clid, request.status))
+    scan.run()
+
+def cbDone(scan):
+    out = open(args.output, "w") if args.output else sys.stdout
+    for (start, end, readable) in scan.regions:
+        out.write("0x%08x-0x%08x %s\n" % (start, end, "readable" if readable else "unreadable"))
+    if out is not sys.stdout:
+        out.close()
+    sys.stderr.write("%d probes in %.1f s\n" % (scan.requests, time.time() - scan.started))
+    loop.quit()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Map the readable regions of receiver memory with UPD-UPLOAD.")
+    parser.add_argument('--device', '-d', default='/dev/ttyACM0')
+    parser.add_argument('--output', '-o', help='Region map file, default stdout')
+    parser.add_argument('--start', type=lambda x: int(x, 0), default=0)
+    parser.add_argument('--end', type=lambda x: int(x, 0), default=1 << 32)
+    parser.add_argument('--step', type=lambda x: int(x, 0), default=64 << 20, help='Distance of the coarse probes')
+    parser.add_argument('--resolution', type=lambda x: int(x, 0), default=4, help='Precision of the region boundaries')
+    parser.add_argument('--window', type=int, default=8, help='Probes in flight')
+    parser.add_argument('--timeout', type=float, default=1.0)
+    args = parser.parse_args()
+
+    t = ubx.Parser(None, device=args.device)
+    scan = ubx.MemoryScan(t, args.start, args.end, args.step, args.resolution, window=args.window,
+                          timeout=args.timeout, callback=cbDone)
+    t.request("CFG-PRT", callback=cbPorts)
+    loop.run()
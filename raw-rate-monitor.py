@@ -30,12 +30,12 @@ prev_t = 0
 
 def callback(ty, *args):
     global prev_t
-    if ty == "RXM-RAW":
-        t = time.time()
-        d = t - prev_t
-        print("%f %f" % (d, 1.0/d))
-        prev_t = t
+    t = time.time()
+    d = t - prev_t
+    print("%f %f" % (d, 1.0/d))
+    prev_t = t
 
 if __name__ == "__main__":
-    t = ubx.Parser(callback)
+    t = ubx.Parser(None)
+    t.subscribe("RXM-RAW", callback)
     gobject.MainLoop().run()
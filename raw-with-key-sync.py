@@ -28,22 +28,19 @@ import sys
 input_event_struct = "@LLHHi"
 input_event_size = struct.calcsize(input_event_struct)
 
-ubxfile = open(sys.argv[1], "w")
+ubxfile = open(sys.argv[1], "wb")
+# Write from a thread so that a slow disk does not stall reading the receiver
+recorder = ubx.Recorder(ubxfile)
 keyfile = open(sys.argv[2], "w")
 itow = False
 week = False
 
 def cbUbxPacket(ty, packet):
     #print("cbUbxPacket %s %s" % (ty, repr(packet)))
-    if ty == "RXM-RAW":
-        global week
-        global itow
-        week = packet[0]["Week"]
-        itow = packet[0]["ITOW"]
-
-def cbUbxRaw(payload):
-    #print("cbUbxRaw %s" % " ".join("%02x" % ord(x) for x in payload))
-    ubxfile.write(payload)
+    global week
+    global itow
+    week = packet[0]["Week"]
+    itow = packet[0]["ITOW"]
 
 def cbButtonPress(source, condition):
     print("cbButtonPress %s %s" % (source, condition))
@@ -67,5 +64,11 @@ if __name__ == "__main__":
     fd = os.open("/dev/input/event4", os.O_NONBLOCK | os.O_RDONLY)
     fcntl.ioctl(fd, 0x40044590, 1) # EVIOCGRAB
     gobject.io_add_watch(fd, gobject.IO_IN, cbButtonPress)
-    ubx.Parser(cbUbxPacket, rawCallback = cbUbxRaw)
-    gobject.MainLoop().run()
+    t = ubx.Parser(None, rawCallback = recorder.write)
+    t.subscribe("RXM-RAW", cbUbxPacket)
+    try:
+        gobject.MainLoop().run()
+    finally:
+        recorder.close()
+        if recorder.stats["dropped"]:
+            print("dropped %(dropped)d chunks, %(dropped_bytes)d bytes of raw data" % recorder.stats)
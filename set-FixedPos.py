@@ -42,13 +42,12 @@ acc = int(sys.argv[4])
 
 
 
-def callbackSAVEexit(ty, packet):
-    print("callback %s" % repr([ty, packet]))
-    #if ty == "ACK-ACK":
-    if packet[0]['MsgID'] == 9:
-        loop.quit()
+def cbDone(transaction):
+    for request in transaction.requests:
+        print("%s: %s" % (request.clid, request.status))
+    loop.quit()
 
-t = ubx.Parser(callbackSAVEexit)
+t = ubx.Parser(None)
 #t.sendraw("\xb5\x62\x06\x71\x28\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x40\x38\x00\x00\xf4\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x0d\x7c")
 #FLAG: 0 Disable
 #: 1:SVIN
@@ -58,7 +57,7 @@ _SVIN=2
 _FIXED=1
 _LONGLAT=256
 flag_pos=_LONGLAT+_SVIN
-t.send("CFG-TMODE3",40,{'version':0,'reserved1':0,'flags':flag_pos,'ecefXOrLat':lat,'ecefYOrLon':lon,'ecefZOrAlt':high,'ecefXOrLatHP':1,'ecefYOrLonHP':1,'ecefZOrAlHP':1,'reserved2':1,'fixedPosAcc':acc,'svinMinDur':1,'svinAccLimit':1,'reserved3_1':1,"reserved3_2":1,"reserved3_3":1,"reserved3_4":1})
+tmode3 = {'version':0,'reserved1':0,'flags':flag_pos,'ecefXOrLat':lat,'ecefYOrLon':lon,'ecefZOrAlt':high,'ecefXOrLatHP':1,'ecefYOrLonHP':1,'ecefZOrAlHP':1,'reserved2':1,'fixedPosAcc':acc,'svinMinDur':1,'svinAccLimit':1,'reserved3_1':1,"reserved3_2":1,"reserved3_3":1,"reserved3_4":1}
 saveMask = buildMask('all', clearMaskShiftDict)
-t.send("CFG-CFG", 12, {'clearMask': 0, 'saveMask': saveMask, 'loadMask': 0})
+t.configure([("CFG-TMODE3", 40, tmode3)], cbDone, save=saveMask)
 loop.run()
@@ -35,15 +35,20 @@ import time
 
 loop = gobject.MainLoop()
 
-def callback(ty, packet):
-    print("callback %s" % repr([ty, packet]))
-    if ty == "CFG-PRT":
-        packet[1]["Baudrate"] = args.baudrate
-        t.send("CFG-PRT", 20, packet)
-    elif ty == "ACK-ACK":
-        os.system("stty -F {} {}".format(t.device, args.baudrate))
+def cbPorts(request):
+    if request.status != "reply":
+        print("polling CFG-PRT failed: %s" % request.status)
         loop.quit()
-    return True
+        return
+    packet = request.data
+    packet[1]["Baudrate"] = args.baudrate
+    t.request("CFG-PRT", 20, packet, callback=cbSet)
+
+def cbSet(request):
+    print("CFG-PRT: %s" % request.status)
+    if request.status == "ack":
+        ubx.configure_tty(t.fd, args.baudrate)
+    loop.quit()
 
 if __name__ == '__main__':
     import argparse
@@ -53,8 +58,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     if args.device is not None:
-        t = ubx.Parser(callback, device=args.device)
+        t = ubx.Parser(None, device=args.device)
     else:
-        t = ubx.Parser(callback)
-    t.send("CFG-PRT", 0, [])
+        t = ubx.Parser(None)
+    t.request("CFG-PRT", callback=cbPorts)
     loop.run()
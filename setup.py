@@ -6,7 +6,7 @@ setup(name='ubx-utils',
                'enable-raw.py',
                'exception1.py',
                'interactive1.py',
-               'memory-map.sh',
+               'memory-map.py',
                'raw-rate-monitor.py',
                'raw-with-key-sync.py',
                'set-baudrate.py',
@@ -16,9 +16,14 @@ setup(name='ubx-utils',
                'set-periodic-logging.py',
                'set-periodic-raw-logging.py',
                'ubx-extract-pos-gpx.py',
+               'ubx-export.py',
                'ubx-extract-raw.py',
                'ubx-parse1.py',
+               'ubx-scan.py',
+               'ubx-server.py',
                'ubx.py',
+               'ubx_asyncio.py',
+               'ubx_daemon.py',
                'upload1.py',
                'upload.py',
               ],
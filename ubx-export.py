@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Export selected fields of several message types from a UBX capture as CSV,
+# JSON Lines or NumPy .npz in a single pass.
+
+import ubx
+import json
+import math
+import mmap
+import operator
+import os
+import sys
+
+class TypeExport():
+    """The fields of one message type to export and how to unpack them.
+
+    Only the selected fields are unpacked, each record with one Struct
+    built by ubx.column_struct(). Messages of variable length types give
+    one row per repeated block if any block field is selected, otherwise
+    one row per message. Without fields, all fields are exported.
+    """
+    def __init__(self, clid, fields=None):
+        self.clid = clid
+        self.key = ubx.CLIDPAIR[clid]
+        self.fields = fields
+        self.plans = {}
+        self.frames = {}
+        self.skipped = 0
+        self.codes = {}
+        names = []
+        for (name, le), v in ubx.MSGFMT.items():
+            if name == clid:
+                if le is not None:
+                    offsets = ubx.field_offsets(v[0], v[1])
+                    fields = v[1]
+                else:
+                    offsets = ubx.field_offsets(v[1], v[2])
+                    offsets.update(ubx.field_offsets(v[4], v[5]))
+                    fields = v[2] + v[5]
+                for field in fields:
+                    self.codes.setdefault(field, offsets[field][1])
+                    if field not in names:
+                        names.append(field)
+        if self.fields is None:
+            self.fields = names
+        missing = [name for name in self.fields if name not in self.codes]
+        if missing:
+            raise KeyError("%s has no field %s, only %s" % (clid, ", ".join(missing), ", ".join(names)))
+        # String, char and float fields are converted before formatting
+        self.strings = any(self.codes[name].endswith("s") or self.codes[name] == "c" for name in self.fields)
+        self.floats = any(self.codes[name] in "fd" for name in self.fields)
+
+    def plan(self, decoder):
+        """Returns (base, rep, getter) for the messages of decoder, or None if
+        they lack some of the fields."""
+        if decoder in self.plans:
+            return self.plans[decoder]
+        plan = None
+        base_fields = [name for name in self.fields if name in decoder.base_names]
+        rep_fields = [name for name in self.fields if name in decoder.rep_names]
+        if len(base_fields) + len(rep_fields) == len(self.fields):
+            (base, base_order) = ubx.column_struct(decoder.base.format, decoder.base_names, base_fields)
+            rep = None
+            rep_order = []
+            if rep_fields:
+                (rep, rep_order) = ubx.column_struct("<" + decoder.rep_format, decoder.rep_names, rep_fields)
+            order = base_order + rep_order
+            indices = [order.index(name) for name in self.fields]
+            if indices == list(range(len(indices))):
+                getter = None
+            elif len(indices) == 1:
+                getter = lambda values, i=indices[0]: (values[i],)
+            else:
+                getter = operator.itemgetter(*indices)
+            plan = (base, rep, getter)
+        self.plans[decoder] = plan
+        return plan
+
+    def rows(self, buf, offset, length):
+        """Returns the rows of the message at offset as tuples of self.fields."""
+        decoder = ubx.get_decoder(self.key[0], self.key[1], length)
+        plan = self.plan(decoder) if decoder is not None else None
+        n = decoder.count(length) if plan is not None else None
+        if n is None:
+            self.skipped += 1
+            return []
+        (base, rep, getter) = plan
+        values = base.unpack_from(buf, offset + 6)
+        if rep is None:
+            rows = [values]
+        else:
+            start = offset + 6 + decoder.base_size
+            rows = [values + rep.unpack_from(buf, pos)
+                    for pos in range(start, start + n * decoder.rep_size, decoder.rep_size)]
+        if getter is not None:
+            rows = [getter(row) for row in rows]
+        return rows
+
+    def add(self, offset, length):
+        """Records a frame to be gathered by table()."""
+        decoder = ubx.get_decoder(self.key[0], self.key[1], length)
+        if decoder is None or self.plan(decoder) is None or decoder.count(length) is None:
+            self.skipped += 1
+            return
+        self.frames.setdefault(decoder, []).append((offset, length))
+
+    def table(self, buf):
+        """Returns a dict of NumPy columns of the frames recorded by add()."""
+        tables = []
+        for decoder, frames in self.frames.items():
+            rep_fields = [name for name in self.fields if name in decoder.rep_names]
+            if decoder.length is not None:
+                table = ubx.gather_columns(buf, [offset for (offset, length) in frames], decoder)
+            elif rep_fields:
+                table = ubx.gather_blocks(buf, frames, decoder)
+            else:
+                dtype = ubx.struct_dtype(decoder.base.format, decoder.base_names)
+                rows = ubx.numpy.asarray(frames, ubx.numpy.int64)[:, :1] + ubx.numpy.arange(6, 6 + decoder.base_size)
+                table = ubx.numpy.frombuffer(buf, ubx.numpy.uint8)[rows].view(dtype).ravel()
+            tables.append((frames[0][0], table))
+        # Frames of the different formats of a type are concatenated in file order of their first frame
+        tables.sort(key=lambda t: t[0])
+        return dict((name, ubx.numpy.concatenate([table[name] for (first, table) in tables]))
+                    for name in self.fields) if tables else {}
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.rstrip(b"\0").decode("latin-1")
+    return value
+
+class TextWriter():
+    """Formats rows with a % format and writes them in chunks of lines."""
+    def __init__(self, f, chunk=4096):
+        self.f = f
+        self.chunk = chunk
+        self.lines = []
+
+    def write(self, fmt, rows):
+        self.lines.extend([fmt % row for row in rows])
+        if len(self.lines) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.lines))
+        self.lines = []
+
+def fieldFormat(export, name):
+    # %r keeps the full precision of floats
+    return "%r" if export.codes[name] in "fd" else "%s"
+
+def csvFormat(export, sep):
+    return sep.join([fieldFormat(export, name) for name in export.fields]) + "\n"
+
+def csvValue(value, sep):
+    if not isinstance(value, bytes):
+        return value
+    # Python 2 writes str, which takes the bytes unchanged
+    value = value.rstrip(b"\0") if str is bytes else text(value)
+    if sep in value or '"' in value or "\n" in value or "\r" in value:
+        value = '"%s"' % value.replace('"', '""')
+    return value
+
+def csvRow(row, sep):
+    return tuple(csvValue(value, sep) for value in row)
+
+def jsonFormat(export):
+    return ('{"type": "%s", ' % export.clid +
+            ", ".join(['"%s": %%s' % name for name in export.fields]) + "}\n")
+
+def jsonValue(value):
+    if isinstance(value, bytes):
+        return json.dumps(text(value))
+    if isinstance(value, float):
+        # JSON has no NaN or infinity
+        return "null" if math.isnan(value) or math.isinf(value) else repr(value)
+    return value
+
+def jsonRow(row):
+    return tuple(jsonValue(value) for value in row)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export message fields from a UBX capture in one pass.")
+    parser.add_argument('filename', help='Specify the UBX capture file.')
+    parser.add_argument('--type', '-t', action='append', required=True,
+                        help='Message type to export with an optional list of fields, e.g. NAV-POSLLH:ITOW,LAT,LON. May be repeated.')
+    parser.add_argument('--format', '-f', choices=['csv', 'jsonl', 'npz'], default='csv')
+    parser.add_argument('--output', '-o', help='Output file; for csv with several types a prefix, one file <prefix>.<type>.csv per type. Default stdout.')
+    parser.add_argument('--sep', default=',', help='CSV separator')
+    parser.add_argument('--start', type=int, help='Only export messages from this GPS time of week (ms) on, using the frame index.')
+    parser.add_argument('--end', type=int, help='Only export messages before this GPS time of week (ms), using the frame index.')
+    args = parser.parse_args()
+
+    exports = {}
+    for spec in args.type:
+        (clid, _, fields) = spec.partition(":")
+        if clid not in ubx.CLIDPAIR:
+            sys.exit("Unknown message type %s" % clid)
+        if ubx.CLIDPAIR[clid] in exports:
+            sys.exit("%s is given more than once" % clid)
+        try:
+            export = TypeExport(clid, fields.split(",") if fields else None)
+        except KeyError as e:
+            sys.exit(e.args[0])
+        exports[export.key] = export
+    if args.format == 'npz' and ubx.numpy is None:
+        sys.exit("npz output requires NumPy")
+    if args.format == 'npz' and not args.output:
+        sys.exit("npz output requires --output")
+
+    if args.start is not None or args.end is not None:
+        records = ubx.load_index(args.filename).select([e.clid for e in exports.values()], args.start, args.end)
+        frames = ((r[0], r[1], r[2], r[3]) for r in records)
+    else:
+        frames = ubx.scan_file(args.filename)
+
+    files = []
+    writers = {}
+    if args.format == 'csv':
+        for export in exports.values():
+            if len(exports) == 1:
+                f = open(args.output, "w") if args.output else sys.stdout
+            else:
+                if not args.output:
+                    sys.exit("csv output of several types requires --output")
+                f = open("%s.%s.csv" % (args.output, export.clid), "w")
+            files.append(f)
+            convert = (lambda row: csvRow(row, args.sep)) if export.strings else None
+            writers[export.key] = (TextWriter(f), csvFormat(export, args.sep), convert)
+            f.write(args.sep.join(export.fields) + "\n")
+    elif args.format == 'jsonl':
+        f = open(args.output, "w") if args.output else sys.stdout
+        files.append(f)
+        writer = TextWriter(f)
+        for export in exports.values():
+            writers[export.key] = (writer, jsonFormat(export), jsonRow if export.strings or export.floats else None)
+
+    f = open(args.filename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+    for (offset, cl, id, length) in frames:
+        export = exports.get((cl, id))
+        if export is None:
+            continue
+        if args.format == 'npz':
+            export.add(offset, length)
+            continue
+        (writer, fmt, convert) = writers[export.key]
+        rows = export.rows(m, offset, length)
+        if convert is not None:
+            rows = [convert(row) for row in rows]
+        writer.write(fmt, rows)
+
+    if args.format == 'npz':
+        arrays = {}
+        for export in exports.values():
+            for name, column in export.table(m).items():
+                arrays["%s.%s" % (export.clid, name)] = column
+        ubx.numpy.savez(args.output, **arrays)
+    for (writer, fmt, convert) in writers.values():
+        writer.flush()
+    for out in files:
+        if out is not sys.stdout:
+            out.close()
+    if size:
+        m.close()
+    f.close()
+    for export in exports.values():
+        if export.skipped:
+            sys.stderr.write("%s: skipped %d messages without the selected fields\n" % (export.clid, export.skipped))
@@ -10,12 +10,18 @@ import sys
 import time
 
 def callback(ty, *args):
-    if ty == 'NAV-POSLLH':
-        lat = float(args[0][0]["LAT"])/10000000
-        lon = float(args[0][0]["LON"])/10000000
-        print("<wpt lat=\"%s\" lon=\"%s\"></wpt>" % (lat, lon))
+    lat = float(args[0][0]["LAT"])/10000000
+    lon = float(args[0][0]["LON"])/10000000
+    print("<wpt lat=\"%s\" lon=\"%s\"></wpt>" % (lat, lon))
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='?', help='Specify the UBX capture file. Its frame index is kept in <filename>.idx. Reads stdin if omitted.')
+    parser.add_argument('--start', type=int, help='Only extract messages from this GPS time of week (ms) on. Requires a filename.')
+    parser.add_argument('--end', type=int, help='Only extract messages before this GPS time of week (ms). Requires a filename.')
+    args = parser.parse_args()
+
     print("""<?xml version="1.0" encoding="UTF-8"?>
 <gpx
   version="1.0"
@@ -23,7 +29,10 @@ if __name__ == "__main__":
   xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
   xmlns="http://www.topografix.com/GPX/1/0"
   xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">""")
-    t = ubx.Parser(callback, device=False)
-    data = sys.stdin.read()
-    t.parse(data)
+    t = ubx.Parser(None, device=False)
+    t.subscribe("NAV-POSLLH", callback)
+    if args.filename is not None:
+        t.parseFile(args.filename, ["NAV-POSLLH"], args.start, args.end)
+    else:
+        t.parseStream(sys.stdin)
     print("</gpx>")
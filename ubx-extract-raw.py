@@ -10,16 +10,22 @@ import sys
 import time
 
 def callback(ty, *args):
-    if ty == 'RXM-RAW':
-        NSV = args[0][0]["NSV"]
-        ITOW = args[0][0]["ITOW"]
-        #print(repr(NSV))
-        for i in xrange(NSV):
-            block = args[0][1 + i]
-            # {'MesQI': 7, 'DOMes': -947.04443359375, 'SV': 16, 'LLI': 0, 'CPMes': 127712782.07132973, 'CNO': 38, 'PRMes': 24302931.671289716}
-            print("%d %s %s %s" % (block["SV"], ITOW, block["PRMes"], block["CPMes"]))
+    NSV = args[0][0]["NSV"]
+    ITOW = args[0][0]["ITOW"]
+    #print(repr(NSV))
+    for i in range(NSV):
+        block = args[0][1 + i]
+        # {'MesQI': 7, 'DOMes': -947.04443359375, 'SV': 16, 'LLI': 0, 'CPMes': 127712782.07132973, 'CNO': 38, 'PRMes': 24302931.671289716}
+        print("%d %s %s %s" % (block["SV"], ITOW, block["PRMes"], block["CPMes"]))
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='?', help='Specify the UBX capture file. Its frame index is kept in <filename>.idx. Reads stdin if omitted.')
+    parser.add_argument('--start', type=int, help='Only extract messages from this GPS time of week (ms) on. Requires a filename.')
+    parser.add_argument('--end', type=int, help='Only extract messages before this GPS time of week (ms). Requires a filename.')
+    args = parser.parse_args()
+
     print("""<?xml version="1.0" encoding="UTF-8"?>
 <gpx
   version="1.0"
@@ -27,7 +33,13 @@ if __name__ == "__main__":
   xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
   xmlns="http://www.topografix.com/GPX/1/0"
   xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">""")
-    t = ubx.Parser(callback, device=False)
-    data = sys.stdin.read()
-    t.parse(data)
+    t = ubx.Parser(None, device=False)
+    t.subscribe("RXM-RAW", callback)
+    if args.filename is not None and ubx.numpy is not None:
+        obs = ubx.decode_file_observations(args.filename, args.start, args.end)
+        ubx.write_table(sys.stdout, obs, ["SV", "ITOW", "PRMes", "CPMes"], fmt="%d %s %s %s")
+    elif args.filename is not None:
+        t.parseFile(args.filename, ["RXM-RAW"], args.start, args.end)
+    else:
+        t.parseStream(sys.stdin)
     print("</gpx>")
@@ -35,11 +35,34 @@ def callback(ty, *args):
     print("callback %s %s" % (ty, repr(args)))
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Parse a UBX capture.")
+    parser.add_argument('filename', help='Binary filename')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Decode with this many processes')
+    parser.add_argument('--range-size', type=int, default=32 << 20, help='Bytes decoded by a process at a time')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check that the parallel decode matches a serial one')
+    args = parser.parse_args()
 
-    if len(sys.argv) < 2:
-        sys.exit('Usage: %s <Binary filename>' % sys.argv[0])
+    if args.check:
+        serial = ubx.parse_range(args.filename, 0, os.path.getsize(args.filename))
+        parallel = list(ubx.parse_parallel(args.filename, processes=args.jobs, size=args.range_size))
+        # repr also compares NaN fields, sorted as pickling reorders dicts
+        def key(message):
+            return repr((message[0], [sorted(d.items()) for d in message[1]]))
+        for (i, (a, b)) in enumerate(zip(serial, parallel)):
+            if key(a) != key(b):
+                sys.exit("Message %d differs: %r != %r" % (i, a, b))
+        if len(serial) != len(parallel):
+            sys.exit("%d messages decoded serially, %d in parallel" % (len(serial), len(parallel)))
+        print("%d messages match" % len(serial))
+        sys.exit()
+
+    if args.jobs > 1:
+        for (ty, data) in ubx.parse_parallel(args.filename, processes=args.jobs, size=args.range_size):
+            callback(ty, data)
+        sys.exit()
 
     t = ubx.Parser(callback, device=False)
-    binFile = sys.argv[1]
-    data = open(binFile,'r').read()
-    t.parse(data)
+    with open(args.filename, 'rb') as f:
+        t.parseStream(f)
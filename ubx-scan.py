@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# List or count the UBX frames of a capture file without decoding them.
+
+import ubx
+
+def frameName(cl, id):
+    return ubx.CLIDPAIR_INV.get((cl, id), "0x%02x-0x%02x" % (cl, id))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='Specify the UBX capture file to scan.')
+    parser.add_argument('--count', '-c', action='store_true', help='Print the number of frames of each type instead of listing them.')
+    parser.add_argument('--type', '-t', nargs='+', help='Only consider these message types, e.g. --type RXM-RAW NAV-POSLLH')
+    args = parser.parse_args()
+
+    wanted = None
+    if args.type is not None:
+        wanted = set(ubx.CLIDPAIR[ty] for ty in args.type)
+
+    counts = {}
+    for (offset, cl, id, length) in ubx.scan_file(args.filename):
+        if wanted is not None and (cl, id) not in wanted:
+            continue
+        if args.count:
+            counts[(cl, id)] = counts.get((cl, id), 0) + 1
+        else:
+            print("%d %s %d" % (offset, frameName(cl, id), length))
+
+    if args.count:
+        for clid, n in sorted(counts.items()):
+            print("%s %d" % (frameName(*clid), n))
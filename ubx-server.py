@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# Copyright (C) 2010 Timo Juhani Lindfors <timo.lindfors@iki.fi>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Share one receiver with many clients: send its raw UBX stream, or only
+# selected message types, to every client of a TCP or Unix socket.
+
+import ubx
+import collections
+import errno
+import os
+import gobject
+import logging
+import socket
+
+class StreamClient():
+    """One connected client and the chunks it still has to be sent.
+
+    Chunks are queued by reference and shared by all clients. A client
+    whose queue grows beyond maxQueue bytes is disconnected.
+    """
+    def __init__(self, server, conn, name):
+        self.server = server
+        self.conn = conn
+        self.name = name
+        self.queue = collections.deque()
+        self.queued = 0
+        self.offset = 0
+        self.writeWatch = None
+        conn.setblocking(False)
+        self.readWatch = gobject.io_add_watch(conn, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, self.cbReadable)
+
+    def push(self, chunk):
+        if self.queued + len(chunk) > self.server.maxQueue:
+            logging.warning("%s is too slow, disconnecting" % self.name)
+            self.close()
+            return
+        self.queue.append(chunk)
+        self.queued += len(chunk)
+        if self.writeWatch is None:
+            self.flush()
+            if self.conn is None:
+                return
+            if self.queue:
+                self.writeWatch = gobject.io_add_watch(self.conn, gobject.IO_OUT, self.cbWritable)
+
+    def flush(self):
+        while self.queue:
+            chunk = self.queue[0]
+            try:
+                n = self.conn.send(memoryview(chunk)[self.offset:])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                logging.info("%s: %s" % (self.name, e))
+                self.close()
+                return
+            self.offset += n
+            if self.offset < len(chunk):
+                return
+            self.queue.popleft()
+            self.queued -= len(chunk)
+            self.offset = 0
+
+    def cbWritable(self, source, condition):
+        self.flush()
+        if self.conn is None:
+            # flush() closed the connection, which removed this watch
+            return False
+        if self.queue:
+            return True
+        self.writeWatch = None
+        return False
+
+    def cbReadable(self, source, condition):
+        # Clients only listen, what they send is discarded
+        try:
+            data = self.conn.recv(4096)
+        except socket.error:
+            data = b""
+        if not data:
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.conn is None:
+            return
+        gobject.source_remove(self.readWatch)
+        if self.writeWatch is not None:
+            gobject.source_remove(self.writeWatch)
+        self.conn.close()
+        self.conn = None
+        self.server.clients.remove(self)
+        logging.info("%s disconnected" % self.name)
+
+class StreamServer():
+    """Sends the raw stream of a Parser to every connected client.
+
+    With types set, only frames of those message types are sent, whole
+    and unmodified. Each chunk read from the receiver is sent to all
+    clients without copying it per client.
+    """
+    def __init__(self, types=None, maxQueue=1 << 20):
+        self.maxQueue = maxQueue
+        self.clients = []
+        self.wanted = None
+        if types:
+            self.wanted = frozenset(ubx.CLIDPAIR[ty] for ty in types)
+            self.framer = ubx.Framer()
+
+    def listen(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.listen(16)
+        gobject.io_add_watch(sock, gobject.IO_IN, self.cbAccept)
+
+    def cbAccept(self, sock, condition):
+        conn, addr = sock.accept()
+        name = "%s:%s" % addr if isinstance(addr, tuple) else "unix client %d" % conn.fileno()
+        logging.info("%s connected" % name)
+        self.clients.append(StreamClient(self, conn, name))
+        return True
+
+    def cbRaw(self, data):
+        if self.wanted is not None:
+            wanted = self.wanted
+            frames = [bytes(buf[start:start + length + 8])
+                      for (buf, start, cl, id, length) in self.framer.frames(data) if (cl, id) in wanted]
+            data = b"".join(frames)
+        if data:
+            for client in list(self.clients):
+                client.push(data)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Send the UBX stream of one receiver to many clients.")
+    parser.add_argument('--device', '-d', default='/dev/ttyACM0')
+    parser.add_argument('--tcp', help='Listen on HOST:PORT')
+    parser.add_argument('--unix', help='Listen on a Unix socket at this path')
+    parser.add_argument('--types', nargs='+', help='Only send these message types, e.g. RXM-RAW')
+    parser.add_argument('--max-queue', type=int, default=1 << 20, help='Bytes queued for a client before it is dropped')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if not args.tcp and not args.unix:
+        args.tcp = "localhost:1235"
+
+    server = StreamServer(args.types, args.max_queue)
+    if args.tcp:
+        (host, port) = args.tcp.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((host, int(port)))
+        server.listen(sock)
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(args.unix)
+        server.listen(sock)
+    t = ubx.Parser(None, rawCallback=server.cbRaw, device=args.device)
+    gobject.MainLoop().run()
@@ -8,13 +8,45 @@ Open GPS Daemon - UBX parser class
 (C) 2008 Openmoko, Inc.
 GPLv2
 """
+import array
 import struct
 import calendar
+import io
 import os
-import gobject
 import logging
+import mmap
+import multiprocessing
 import sys
 import socket
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import gobject
+except ImportError:
+    gobject = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+try:
+    xrange
+except NameError:
+    xrange = range
 
 SYNC1=0xb5
 SYNC2=0x62
@@ -29,9 +61,16 @@ CLASS = {
     "MON" : 0x0a,
     "AID" : 0x0b,
     "TIM" : 0x0d,
+    "ESF" : 0x10,
+    "MGA" : 0x13,
+    "LOG" : 0x21,
+    "SEC" : 0x27,
+    "HNR" : 0x28,
     "USR" : 0x40
 }
 
+CLASSES = frozenset(CLASS.values())
+
 CLIDPAIR = {
     "ACK-ACK" : (0x05, 0x01),
     "ACK-NACK" : (0x05, 0x00),
@@ -265,6 +304,11 @@ MSGFMT = {
         ["<II" + "B", ["StartAddr", "Flags", "B0"]],
     ("UPD-DOWNL", 8) :
         ["<II", ["StartAddr", "Flags"]],
+# Followed by memory bytes of any number, see Message.raw()
+    ("UPD-UPLOAD", None) :
+        [12, "<III", ["StartAddr", "DataSize", "Flags"], 0, "", []],
+    ("UPD-DOWNL", None) :
+        [8, "<II", ["StartAddr", "Flags"], 0, "", []],
     ("MON-SCHD", 24) :
         ["<IIIIHHHBB", ["TSKRUN", "TSKSCHD", "TSKOVRR", "TSKREG", "STACK", "STACKSIZE", "CPUIDLE", "FLYSLY", "PTLSLY"]],
 # MON - GPS system statistics
@@ -303,6 +347,230 @@ MSGFMT = {
 
 MSGFMT_INV = dict( [ [(CLIDPAIR[clid], le),v + [clid]] for (clid, le),v in MSGFMT.items() ] )
 
+def field_offsets(format, names):
+    """Returns a dict mapping each field name of a struct format to (offset, code).
+
+    code is the struct code of the field, including the count for strings.
+    """
+    offsets = {}
+    names = iter(names)
+    offset = 0
+    count = ""
+    for c in format.lstrip("<"):
+        if c.isdigit():
+            count += c
+            continue
+        n = int(count or 1)
+        count = ""
+        if c == "x":
+            offset += n
+        elif c == "s":
+            offsets[next(names)] = (offset, "%ds" % n)
+            offset += n
+        else:
+            size = struct.calcsize("<" + c)
+            for i in xrange(n):
+                offsets[next(names)] = (offset, c)
+                offset += size
+    return offsets
+
+def column_struct(format, names, columns):
+    """Returns a Struct that unpacks only columns from a record of format, and
+    the columns in the order it returns them.
+
+    The fields in between are skipped as pad bytes and never unpacked.
+    """
+    offsets = field_offsets(format, names)
+    missing = [name for name in columns if name not in offsets]
+    if missing:
+        raise KeyError("no field %s in %s" % (", ".join(missing), format))
+    ordered = sorted(columns, key=lambda name: offsets[name][0])
+    fmt = "<"
+    pos = 0
+    for name in ordered:
+        (offset, code) = offsets[name]
+        if offset > pos:
+            fmt += "%dx" % (offset - pos)
+        fmt += code
+        pos = offset + struct.calcsize("<" + code)
+    return (struct.Struct(fmt), ordered)
+
+class Message(object):
+    """Base class of the message classes generated from MSGFMT.
+
+    A message keeps a reference to the payload and unpacks a field only when
+    it is read, either as an attribute or with dict-style access. Fields that
+    are assigned are kept aside so that modified messages can be sent back.
+    """
+    __slots__ = ("_payload", "_offset", "_values")
+    name = None
+    names = ()
+    fields = {}
+
+    def __init__(self, payload, offset=0):
+        self._payload = payload
+        self._offset = offset
+        self._values = None
+
+    def __getitem__(self, name):
+        if self._values is not None and name in self._values:
+            return self._values[name]
+        (offset, unpacker) = self.fields[name]
+        return unpacker.unpack_from(self._payload, self._offset + offset)[0]
+
+    def __setitem__(self, name, value):
+        if name not in self.fields:
+            raise KeyError(name)
+        if self._values is None:
+            self._values = {}
+        self._values[name] = value
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name, default=None):
+        if name in self.fields:
+            return self[name]
+        return default
+
+    def raw(self, start=0, end=None):
+        """Returns the payload bytes from start to end, counted from the
+        start of this message, such as the memory bytes of UPD-UPLOAD."""
+        end = len(self._payload) if end is None else self._offset + end
+        return bytes(self._payload[self._offset + start:end])
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return [self[name] for name in self.names]
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+def message_class(classname, name, format, names):
+    """Returns a Message subclass with one property per field of format."""
+    fields = {}
+    attrs = {"__slots__": (), "name": name, "names": tuple(names), "fields": fields}
+    for field, (offset, code) in field_offsets(format, names).items():
+        fields[field] = (offset, struct.Struct("<" + code))
+        attrs[field] = property(lambda self, field=field: self[field],
+                                lambda self, value, field=field: self.__setitem__(field, value))
+    return type(classname, (Message,), attrs)
+
+class Decoder():
+    """Decodes the payload of one MSGFMT entry.
+
+    decode() returns lazy Message objects of the generated classes base_class
+    and rep_class, unpack() returns dicts using precompiled structs.
+    Fixed length messages have no repeated section (rep_size is 0). For
+    variable length messages unpack() reads all repeated blocks with a single
+    struct per block count, cached in self.blocks.
+    """
+    def __init__(self, clid, length, format):
+        self.clid = clid
+        self.length = length
+        if length is not None:
+            format = [length] + format + [0, "", []]
+        self.base_size = format[0]
+        self.base = struct.Struct(format[1])
+        self.base_names = format[2]
+        self.rep_size = format[3]
+        self.rep_format = format[4].lstrip("<")
+        self.rep_names = format[5]
+        self.blocks = {}
+        classname = clid.replace("-", "_")
+        if length is not None:
+            classname += "_%d" % length
+        self.base_class = message_class(classname, clid, format[1], self.base_names)
+        self.rep_class = message_class(classname + "_Block", clid, self.rep_format, self.rep_names)
+
+    def count(self, length):
+        """Returns the number of repeated blocks, or None if length is invalid.
+
+        A variable length format without blocks is followed by any number
+        of bytes.
+        """
+        if self.rep_size == 0:
+            if length == self.base_size or (self.length is None and length > self.base_size):
+                return 0
+            return None
+        if length < self.base_size or (length - self.base_size) % self.rep_size != 0:
+            return None
+        return (length - self.base_size) // self.rep_size
+
+    def block_struct(self, n):
+        try:
+            return self.blocks[n]
+        except KeyError:
+            s = self.blocks[n] = struct.Struct("<" + self.rep_format * n)
+            return s
+
+    def decode(self, length, payload, offset=0):
+        data = [self.base_class(payload, offset)]
+        n = self.count(length)
+        if n:
+            rep_class = self.rep_class
+            start = offset + self.base_size
+            data.extend([rep_class(payload, i) for i in xrange(start, start + n * self.rep_size, self.rep_size)])
+        return data
+
+    def unpack(self, length, payload, offset=0):
+        data = [dict(zip(self.base_names, self.base.unpack_from(payload, offset)))]
+        n = self.count(length)
+        if n:
+            values = self.block_struct(n).unpack_from(payload, offset + self.base_size)
+            names = self.rep_names
+            k = len(names)
+            for i in xrange(0, n * k, k):
+                data.append(dict(zip(names, values[i:i + k])))
+        return data
+
+DECODERS = dict( [ [(CLIDPAIR[clid], le), Decoder(clid, le, v)] for (clid, le),v in MSGFMT.items() ] )
+
+def get_decoder(cl, id, length):
+    """Returns the Decoder for a message, or None if it is unknown."""
+    decoder = DECODERS.get(((cl, id), length))
+    if decoder is None:
+        decoder = DECODERS.get(((cl, id), None))
+    return decoder
+
+# TIMEFIELDS - Offsets of the GPS time of week (ms) and of the GPS week number
+# in the navigation and receiver messages that carry them. The week offset is
+# None if the message only has the time of week.
+def time_fields():
+    fields = {}
+    for (clid, le), v in MSGFMT.items():
+        if clid[:3] not in ("NAV", "RXM"):
+            continue
+        offsets = field_offsets(*(v[:2] if le is not None else v[1:3]))
+        itow = offsets.get("ITOW", offsets.get("iTOW"))
+        if itow is not None:
+            week = offsets.get("week", offsets.get("Week"))
+            fields[CLIDPAIR[clid]] = (itow[0], week[0] if week else None)
+    return fields
+
+TIMEFIELDS = time_fields()
+
 GNSSID = {'GPS': 0,
           'SBAS': 1,
           'Galileo': 2,
@@ -312,7 +580,7 @@ GNSSID = {'GPS': 0,
           'GLONASS': 6,
          }
 
-GNSSID_INV = dict( [(v,k) for k, v in GNSSID.iteritems()] )
+GNSSID_INV = dict( [(v,k) for k, v in GNSSID.items()] )
 
 clearMaskShiftDict = {'ioPort':   0,
              'msgConf':  1,
@@ -360,71 +628,1411 @@ def buildMask(enabledBits, shiftDict):
 
     return mask
 
+SYNC = struct.pack("BB", SYNC1, SYNC2)
+HEADER = struct.Struct("<BBH")
+CHECKSUM = struct.Struct("<BB")
+
+# Largest payload accepted from a message type without a known bound
+MAX_PAYLOAD = 8192
+
+def max_lengths():
+    """Returns the largest known payload length of the variable length types
+    whose header counts the repeated blocks in one byte."""
+    lengths = {}
+    for (clid, le), v in MSGFMT.items():
+        # UPD messages carry memory blocks of any size
+        if le is None and v[0] > 0 and not clid.startswith("UPD-"):
+            lengths[CLIDPAIR[clid]] = v[0] + 255 * v[3]
+    return lengths
+
+MAXLEN = max_lengths()
+
+def fixed_lengths():
+    """Returns the known payload lengths of the types that only have fixed
+    length formats. A length of 0, a poll, is always known."""
+    lengths = {}
+    variable = set(CLIDPAIR[clid] for (clid, le) in MSGFMT if le is None)
+    for (clid, le) in MSGFMT:
+        if CLIDPAIR[clid] not in variable:
+            lengths.setdefault(CLIDPAIR[clid], set([0])).add(le)
+    return dict((key, frozenset(v)) for (key, v) in lengths.items())
+
+FIXEDLEN = fixed_lengths()
+
+class Framer():
+    """Splits a byte stream into UBX frames.
+
+    Data that cannot be framed yet is kept in a preallocated bytearray with a
+    read cursor (rpos) and a write cursor (wpos). The buffer is only compacted
+    when the write cursor reaches its end, so consuming a frame never copies
+    the rest of the stream. While nothing is pending, frames are located
+    directly in the buffer handed to frames() and only the unframed tail is
+    copied, which keeps memory bounded by the largest frame. Once the header
+    of an incomplete frame has been validated, the framer only waits for the
+    missing bytes (self.need) and does not search its payload for sync bytes.
+
+    A sync pattern only starts a frame if it is followed by a known class and
+    a length of at most MAX_PAYLOAD; whether it is a frame is then decided by
+    its checksum. The lengths known for each type, see MAXLEN and FIXEDLEN,
+    only decide how to wait for an incomplete frame: a frame of unexpected
+    length is not waited for as long as valid frames follow it, but is kept
+    and rescanned as data arrives (self.rescan) in case it is complete after
+    all. Corruption is counted in self.stats rather than logged: bytes
+    discarded between frames, frames with a bad checksum and sync patterns
+    with an implausible header.
+    """
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.rpos = 0
+        self.wpos = 0
+        self.stop = 0
+        self.need = 0
+        self.rescan = False
+        self.stats = {"frames": 0, "discarded": 0, "bad_checksum": 0, "false_sync": 0}
+
+    def pending(self):
+        return self.wpos - self.rpos
+
+    def feed(self, data, start=0, end=None):
+        if end is None:
+            end = len(data)
+        n = end - start
+        if self.wpos + n > len(self.buf):
+            self.compact(n)
+        self.buf[self.wpos:self.wpos + n] = data[start:end]
+        self.wpos += n
+
+    def compact(self, extra=0):
+        pending = self.wpos - self.rpos
+        if pending + extra > len(self.buf):
+            buf = bytearray(max(2 * len(self.buf), pending + extra))
+        else:
+            buf = self.buf
+        buf[:pending] = self.buf[self.rpos:self.wpos]
+        self.buf = buf
+        self.rpos = 0
+        self.wpos = pending
+
+    def frames(self, data, end=None):
+        """Yields (buffer, start, cl, id, length) for every complete frame in
+        data[:end].
+
+        The payload of each frame is buffer[start+6:start+6+length]; it is
+        only valid until the generator is resumed.
+        """
+        pos = 0
+        if end is None:
+            end = len(data)
+        while self.rpos != self.wpos:
+            if pos == end:
+                return
+            # Copy only what is needed to complete the pending frame
+            n = min(end - pos, self.wanted())
+            self.feed(data, pos, pos + n)
+            pos += n
+            if self.wpos - self.rpos < self.need and not self.rescan:
+                return
+            for frame in self.scan(self.buf, self.rpos, self.wpos):
+                yield (self.buf,) + frame
+            self.rpos = self.stop
+        # Nothing pending, frame straight from the caller's buffer
+        self.rpos = self.wpos = 0
+        for frame in self.scan(data, pos, end):
+            yield (data,) + frame
+        self.feed(data, self.stop, end)
+
+    def wanted(self):
+        """Returns how many bytes are missing to the pending frame, or to its
+        header if that has not been seen yet."""
+        pending = self.wpos - self.rpos
+        if self.need:
+            return self.need - pending
+        return max(8 - pending, 1)
+
+    def scan(self, buf, pos, end, eof=False):
+        """Yields (start, cl, id, length) for every valid frame in buf[pos:end].
+
+        Scanning ends at the first incomplete frame of a length expected for
+        its type. Afterwards self.stop is the offset of the first byte that
+        may still belong to a frame, self.need the size of that frame if its
+        header has been seen and self.rescan whether its length is unexpected,
+        in which case more frames may follow it. With eof set buf[pos:end] is all there is, as for a
+        file, and a header running past end is a false sync instead.
+        """
+        stats = self.stats
+        classes = CLASSES
+        hold = None
+        doubtful = None
+        mark = pos
+        while end - pos >= 8:
+            start = buf.find(SYNC, pos, end)
+            if start == -1 or end - start < 8:
+                break
+            (cl, id, length) = HEADER.unpack_from(buf, start + 2)
+            if cl not in classes or length > MAX_PAYLOAD:
+                stats["false_sync"] += 1
+                pos = start + 2
+                continue
+            if end - start < length + 8:
+                if eof:
+                    stats["false_sync"] += 1
+                    pos = start + 2
+                    continue
+                key = (cl, id)
+                if length <= MAXLEN.get(key, MAX_PAYLOAD) and length in FIXEDLEN.get(key, (length,)):
+                    # Wait for the rest of this frame instead of rescanning it
+                    hold = start
+                    self.need = length + 8
+                    break
+                # Unexpected length, look for valid frames behind it
+                if doubtful is None:
+                    doubtful = (start, length + 8)
+                pos = start + 2
+                continue
+            if checksum(buf, start + 2, start + length + 6) != CHECKSUM.unpack_from(buf, start + length + 6):
+                stats["bad_checksum"] += 1
+                pos = start + 2
+                continue
+            if doubtful is not None:
+                stats["false_sync"] += 1
+                doubtful = None
+            stats["discarded"] += start - mark
+            stats["frames"] += 1
+            yield (start, cl, id, length)
+            pos = mark = start + length + 8
+        self.rescan = doubtful is not None
+        if doubtful is not None:
+            (self.stop, self.need) = doubtful
+        elif hold is not None:
+            self.stop = hold
+        else:
+            self.need = 0
+            start = buf.find(SYNC, pos, end)
+            if start == -1:
+                # Keep a trailing SYNC1, it may start the next frame
+                start = end - 1 if end > pos and buf[end - 1:end] == SYNC[:1] else end
+            self.stop = start
+        stats["discarded"] += self.stop - mark
+
+def checksum(buf, start=0, end=None):
+    """Returns the UBX checksum (ck_a, ck_b) of buf[start:end].
+
+    Adler-32 keeps the same two running sums modulo 65521. Over blocks of at
+    most 22 bytes neither sum can wrap, so zlib yields the exact block sums,
+    which are combined here modulo 256.
+    """
+    if end is None:
+        end = len(buf)
+    if numpy is not None and end - start >= 256:
+        a = numpy.frombuffer(buf, numpy.uint8, end - start, start)
+        ck_a = int(a.sum())
+        ck_b = (end - start) * ck_a - int(numpy.dot(a, numpy.arange(end - start)))
+        return (ck_a & 0xff, ck_b & 0xff)
+    msg = bytes(buf[start:end])
+    ck_a = 0
+    ck_b = 0
+    for i in xrange(0, len(msg), 22):
+        block = msg[i:i + 22]
+        sums = zlib.adler32(block, 0) & 0xffffffff
+        ck_b = ck_b + len(block) * ck_a + (sums >> 16)
+        ck_a = ck_a + (sums & 0xffff)
+    return (ck_a & 0xff, ck_b & 0xff)
+
+def build_frame(clid, payload):
+    """Returns the UBX frame of message type clid carrying the bytes payload."""
+    header = struct.pack("<BBH", CLIDPAIR[clid][0], CLIDPAIR[clid][1], len(payload))
+    return SYNC + header + payload + CHECKSUM.pack(*checksum(header + payload))
+
+def verify_frames(buf, frames):
+    """Checks the checksums of many frames of buf in one call.
+
+    frames is a sequence of (start, length) tuples, where start is the offset
+    of the sync bytes and length the payload length. Returns a list of
+    booleans. With NumPy the running sums of the whole span covered by the
+    frames are computed once, so frames should be close together.
+    """
+    if len(frames) == 0:
+        return []
+    if numpy is None:
+        return [checksum(buf, start + 2, start + length + 6) == CHECKSUM.unpack_from(buf, start + length + 6)
+                for (start, length) in frames]
+    spans = numpy.array(frames, numpy.int64).reshape(-1, 2)
+    lo = int(spans[:, 0].min())
+    hi = int((spans[:, 0] + spans[:, 1]).max()) + 8
+    a = numpy.frombuffer(buf, numpy.uint8, hi - lo, lo)
+    # Running sums of a[i] and i*a[i], modulo 256 through uint8 wrap-around
+    sa = numpy.zeros(len(a) + 1, numpy.uint8)
+    numpy.cumsum(a, dtype=numpy.uint8, out=sa[1:])
+    sw = numpy.zeros(len(a) + 1, numpy.uint8)
+    numpy.cumsum(numpy.resize(numpy.arange(256, dtype=numpy.uint8), len(a)) * a, dtype=numpy.uint8, out=sw[1:])
+    b = spans[:, 0] - lo + 2
+    e = b + spans[:, 1] + 4
+    ck_a = sa[e] - sa[b]
+    ck_b = e.astype(numpy.uint8) * ck_a - (sw[e] - sw[b])
+    return ((ck_a == a[e]) & (ck_b == a[e + 1])).tolist()
+
+def scan_file(path):
+    """Yields (offset, cl, id, length) for every valid UBX frame of a capture.
+
+    The file is memory-mapped and payloads are not decoded, so garbage and
+    NMEA sentences are skipped without reading the capture into memory.
+    """
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for frame in Framer().scan(m, 0, size, eof=True):
+                yield frame
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def frame_length(buf, start, end):
+    """Returns the length of the valid frame at buf[start:end], or None."""
+    if end - start < 8 or buf[start:start + 2] != SYNC:
+        return None
+    (cl, id, length) = HEADER.unpack_from(buf, start + 2)
+    if cl not in CLASSES or length > MAX_PAYLOAD or end - start < length + 8:
+        return None
+    if checksum(buf, start + 2, start + length + 6) != CHECKSUM.unpack_from(buf, start + length + 6):
+        return None
+    return length + 8
+
+def resync(buf, pos, end):
+    """Returns the offset of the first frame boundary at or after pos.
+
+    A boundary is a valid frame that is followed by another valid frame or
+    by end, so a sync pattern inside a payload is not taken for one.
+    Returns end if there is none.
+    """
+    while True:
+        start = buf.find(SYNC, pos, end)
+        if start == -1:
+            return end
+        n = frame_length(buf, start, end)
+        if n is not None and (start + n == end or frame_length(buf, start + n, end) is not None):
+            return start
+        pos = start + 1
+
+def file_ranges(path, size=32 << 20):
+    """Returns (start, end) byte ranges of about size bytes covering a
+    capture, each starting on a frame boundary."""
+    f = open(path, 'rb')
+    try:
+        total = os.fstat(f.fileno()).st_size
+        if total == 0:
+            return []
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            bounds = [0]
+            for pos in xrange(size, total, size):
+                bound = resync(m, max(pos, bounds[-1]), total)
+                if bound > bounds[-1]:
+                    bounds.append(bound)
+        finally:
+            m.close()
+    finally:
+        f.close()
+    return list(zip(bounds, bounds[1:] + [total]))
+
+def parse_range(path, start, end, types=None):
+    """Returns the (ty, data) of every message in path[start:end].
+
+    data is a list of dicts as from Decoder.unpack(). types, a collection
+    of message names, restricts decoding to those messages. The messages
+    are those of frames starting in the range; the scan reads past end as
+    far as needed to complete them, so adjacent ranges give the same
+    messages as one range covering both.
+    """
+    wanted = frozenset(CLIDPAIR[ty] for ty in types) if types else None
+    messages = []
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return messages
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for (offset, cl, id, length) in Framer().scan(m, start, size, eof=True):
+                if offset >= end:
+                    break
+                if wanted is not None and (cl, id) not in wanted:
+                    continue
+                decoder = get_decoder(cl, id, length)
+                if decoder is not None and decoder.count(length) is not None:
+                    messages.append((CLIDPAIR_INV[(cl, id)], decoder.unpack(length, m, offset + 6)))
+        finally:
+            m.close()
+    finally:
+        f.close()
+    return messages
+
+def parse_range_job(job):
+    (path, start, end, types, reducer) = job
+    messages = parse_range(path, start, end, types)
+    return messages if reducer is None else reducer(messages)
+
+def parse_parallel(path, types=None, processes=None, size=32 << 20, reducer=None):
+    """Decodes a capture with a pool of processes.
+
+    The file is cut into ranges of about size bytes on frame boundaries, see
+    file_ranges(), and every range is decoded by parse_range() in a worker.
+    Without reducer, yields (ty, data) for every message in file order. With
+    reducer, a module level function, reducer(messages) is called in the
+    worker on the messages of each range and its results are yielded in
+    file order.
+    """
+    jobs = [(path, start, end, types, reducer) for (start, end) in file_ranges(path, size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(parse_range_job, jobs):
+            if reducer is not None:
+                yield result
+            else:
+                for message in result:
+                    yield message
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Version 2: frames after a false sync near the end are no longer missing
+INDEX_MAGIC = b"UBXIDX2\n"
+INDEX_HEADER = struct.Struct("<8sQd")
+INDEX_RECORD = struct.Struct("<QBBHhI")
+INDEX_DTYPE = [("offset", "<u8"), ("cl", "u1"), ("id", "u1"), ("length", "<u2"), ("week", "<i2"), ("itow", "<u4")]
+NO_WEEK = -1
+NO_ITOW = 0xffffffff
+
+class CaptureIndex():
+    """Frame index of a capture file, as built by build_index().
+
+    Each record is (offset, cl, id, length, week, itow). week and itow are the
+    GPS time of the frame, or of the latest frame before it that carried one,
+    and are NO_WEEK/NO_ITOW if not known yet. The records are read from
+    data, usually the mapped index file, from offset on.
+    """
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def __len__(self):
+        return (len(self.data) - self.offset) // INDEX_RECORD.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("index record out of range")
+        return INDEX_RECORD.unpack_from(self.data, self.offset + i * INDEX_RECORD.size)
+
+    def __iter__(self):
+        for offset in xrange(self.offset, len(self.data), INDEX_RECORD.size):
+            yield INDEX_RECORD.unpack_from(self.data, offset)
+
+    def select(self, types=None, start=None, end=None):
+        """Returns the records of the given message types within [start, end).
+
+        types is a list of message names or (class, id) pairs. start and end
+        are either a GPS time of week in ms or a (week, ms) tuple.
+        """
+        if types is not None:
+            types = set(CLIDPAIR.get(ty, ty) for ty in types)
+        if numpy is None:
+            return [r for r in self if (types is None or (r[1], r[2]) in types) and
+                    in_time_range(r[4], r[5], start, end)]
+        if len(self) == 0:
+            return []
+        records = numpy.frombuffer(self.data, INDEX_DTYPE, len(self), self.offset)
+        mask = numpy.ones(len(records), bool)
+        if types is not None:
+            clid = records["cl"].astype(numpy.uint16) << 8 | records["id"]
+            mask &= numpy.isin(clid, [cl << 8 | id for (cl, id) in types])
+        if start is not None or end is not None:
+            mask &= records["itow"] != NO_ITOW
+            for (bound, keep) in ((start, numpy.greater_equal), (end, numpy.less)):
+                if bound is None:
+                    continue
+                if isinstance(bound, tuple):
+                    mask &= records["week"] != NO_WEEK
+                    t = records["week"].astype(numpy.int64) * 604800000 + records["itow"]
+                    mask &= keep(t, bound[0] * 604800000 + bound[1])
+                else:
+                    mask &= keep(records["itow"], bound)
+        return records[mask].tolist()
+
+def in_time_range(week, itow, start, end):
+    if start is None and end is None:
+        return True
+    if itow == NO_ITOW:
+        return False
+    for (bound, sign) in ((start, 1), (end, -1)):
+        if bound is None:
+            continue
+        if isinstance(bound, tuple):
+            if week == NO_WEEK:
+                return False
+            t = (week, itow)
+        else:
+            t = itow
+        if (sign > 0 and t < bound) or (sign < 0 and t >= bound):
+            return False
+    return True
+
+def write_index(path, out):
+    """Scans a capture file and writes its index to the file object out."""
+    st = os.stat(path)
+    out.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime))
+    records = bytearray()
+    week = NO_WEEK
+    itow = NO_ITOW
+    f = open(path, 'rb')
+    try:
+        if st.st_size > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for (offset, cl, id, length) in Framer().scan(m, 0, st.st_size, eof=True):
+                    fields = TIMEFIELDS.get((cl, id))
+                    if fields is not None and length >= fields[0] + 4:
+                        (itow,) = struct.unpack_from("<I", m, offset + 6 + fields[0])
+                        if fields[1] is not None and length >= fields[1] + 2:
+                            (week,) = struct.unpack_from("<h", m, offset + 6 + fields[1])
+                    records += INDEX_RECORD.pack(offset, cl, id, length, week, itow)
+                    if len(records) >= 65536:
+                        out.write(records)
+                        del records[:]
+            finally:
+                m.close()
+    finally:
+        f.close()
+    out.write(records)
+
+def map_index(indexpath):
+    """Maps an index file into memory.
+
+    Returns its (magic, size, mtime) header and its CaptureIndex, or None if
+    the file cannot be an index.
+    """
+    f = open(indexpath, 'rb')
+    try:
+        length = os.fstat(f.fileno()).st_size
+        if length < INDEX_HEADER.size or (length - INDEX_HEADER.size) % INDEX_RECORD.size != 0:
+            return None
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    return (INDEX_HEADER.unpack_from(m), CaptureIndex(m, INDEX_HEADER.size))
+
+def build_index(path, indexpath=None):
+    """Scans a capture file and writes its index next to it (path + ".idx").
+
+    Returns the CaptureIndex. The records are written to the index file as
+    they are found and the file is then mapped, so memory use does not grow
+    with the capture. Failing to write the index file is not an error, the
+    index is then kept in memory.
+    """
+    if indexpath is None:
+        indexpath = path + ".idx"
+    os.stat(path)
+    tmppath = indexpath + ".tmp"
+    try:
+        out = open(tmppath, 'wb')
+        try:
+            write_index(path, out)
+        finally:
+            out.close()
+        os.rename(tmppath, indexpath)
+    except (IOError, OSError) as e:
+        logging.warning("Cannot write index %s: %s" % (indexpath, e))
+        out = io.BytesIO()
+        write_index(path, out)
+        return CaptureIndex(out.getvalue(), INDEX_HEADER.size)
+    return map_index(indexpath)[1]
+
+def load_index(path, indexpath=None):
+    """Returns the CaptureIndex of a capture file.
+
+    The index file is reused if it matches the size and mtime of the capture,
+    otherwise it is rebuilt.
+    """
+    if indexpath is None:
+        indexpath = path + ".idx"
+    st = os.stat(path)
+    try:
+        mapped = map_index(indexpath)
+    except (IOError, OSError):
+        return build_index(path, indexpath)
+    if mapped is not None:
+        ((magic, size, mtime), index) = mapped
+        if magic == INDEX_MAGIC and size == st.st_size and mtime == st.st_mtime:
+            return index
+        index.data.close()
+    return build_index(path, indexpath)
+
+# Struct codes and the equivalent little endian NumPy types
+DTYPES = {"c": "S1", "b": "i1", "B": "u1", "h": "<i2", "H": "<u2", "i": "<i4", "I": "<u4",
+          "l": "<i4", "L": "<u4", "q": "<i8", "Q": "<u8", "f": "<f4", "d": "<f8"}
+
+def struct_dtype(format, names):
+    """Returns the NumPy structured dtype equivalent to a struct format."""
+    offsets = field_offsets(format, names)
+    formats = []
+    for name in names:
+        code = offsets[name][1]
+        formats.append("S" + code[:-1] if code.endswith("s") else DTYPES[code])
+    return numpy.dtype({"names": list(names), "formats": formats,
+                        "offsets": [offsets[name][0] for name in names],
+                        "itemsize": struct.calcsize(format)})
+
+def fixed_decoder(clid, length=None):
+    """Returns the Decoder of a fixed length message type."""
+    lengths = [le for (name, le) in MSGFMT if name == clid and le is not None]
+    if length is None and len(lengths) == 1:
+        length = lengths[0]
+    if length not in lengths:
+        raise ValueError("%s has no fixed length format of length %s, must be one of %s" % (clid, length, lengths))
+    return DECODERS[(CLIDPAIR[clid], length)]
+
+def gather_columns(buf, offsets, decoder):
+    """Copies the payloads of the frames at offsets into a structured array."""
+    dtype = struct_dtype(decoder.base.format, decoder.base_names)
+    if len(offsets) == 0:
+        return numpy.zeros(0, dtype)
+    rows = numpy.asarray(offsets, numpy.int64)[:, None] + numpy.arange(6, 6 + decoder.length)
+    return numpy.frombuffer(buf, numpy.uint8)[rows].view(dtype).ravel()
+
+def decode_columns(buf, clid, length=None):
+    """Decodes every clid message of a buffer into a NumPy structured array.
+
+    Only fixed length message types are supported; length selects between
+    the formats of types that have several. The dtype has one field per
+    MSGFMT field name.
+    """
+    if numpy is None:
+        raise ImportError("decode_columns requires NumPy")
+    decoder = fixed_decoder(clid, length)
+    key = CLIDPAIR[clid] + (decoder.length,)
+    offsets = [start for (start, cl, id, le) in Framer().scan(buf, 0, len(buf), eof=True) if (cl, id, le) == key]
+    return gather_columns(buf, offsets, decoder)
+
+def decode_file_columns(path, clid, length=None, start=None, end=None):
+    """Like decode_columns() for a capture file, using its frame index.
+
+    See CaptureIndex.select() for start and end.
+    """
+    if numpy is None:
+        raise ImportError("decode_file_columns requires NumPy")
+    decoder = fixed_decoder(clid, length)
+    offsets = [r[0] for r in load_index(path).select([clid], start, end) if r[3] == decoder.length]
+    if not offsets:
+        return gather_columns(b"", offsets, decoder)
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return gather_columns(m, offsets, decoder)
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def gather_blocks(buf, frames, decoder):
+    """Copies the repeated blocks of variable length frames into one table.
+
+    frames is a list of (offset, length) tuples. Returns a structured array
+    with one row per block, holding the index of its frame in "epoch", the
+    fields of the frame header and the fields of the block.
+    """
+    base = struct_dtype(decoder.base.format, decoder.base_names)
+    rep = struct_dtype("<" + decoder.rep_format, decoder.rep_names)
+    names = ["epoch"] + list(base.names) + list(rep.names)
+    if len(set(names)) != len(names):
+        raise ValueError("%s has the same field name in header and blocks" % decoder.clid)
+    dtype = numpy.dtype([("epoch", "<u4")] + [(name, base.fields[name][0]) for name in base.names] +
+                        [(name, rep.fields[name][0]) for name in rep.names])
+    if len(frames) == 0:
+        return numpy.zeros(0, dtype)
+    frames = numpy.asarray(frames, numpy.int64).reshape(-1, 2)
+    counts = (frames[:, 1] - decoder.base_size) // decoder.rep_size
+    a = numpy.frombuffer(buf, numpy.uint8)
+    headers = a[frames[:, 0][:, None] + numpy.arange(6, 6 + decoder.base_size)].view(base).ravel()
+    epoch = numpy.repeat(numpy.arange(len(frames)), counts)
+    first = numpy.cumsum(counts) - counts
+    starts = (frames[epoch, 0] + 6 + decoder.base_size +
+              (numpy.arange(len(epoch)) - first[epoch]) * decoder.rep_size)
+    blocks = a[starts[:, None] + numpy.arange(decoder.rep_size)].view(rep).ravel()
+    table = numpy.empty(len(epoch), dtype)
+    table["epoch"] = epoch
+    for name in base.names:
+        table[name] = headers[name][epoch]
+    for name in rep.names:
+        table[name] = blocks[name]
+    return table
+
+def decode_observations(buf):
+    """Decodes every RXM-RAW message of a buffer into a flat observation table.
+
+    Returns a structured array with one row per satellite measurement and the
+    columns epoch, ITOW, Week, NSV, CPMes, PRMes, DOMes, SV, MesQI, CNO and
+    LLI, where epoch numbers the RXM-RAW messages.
+    """
+    if numpy is None:
+        raise ImportError("decode_observations requires NumPy")
+    decoder = DECODERS[(CLIDPAIR["RXM-RAW"], None)]
+    frames = [(start, le) for (start, cl, id, le) in Framer().scan(buf, 0, len(buf), eof=True)
+              if (cl, id) == CLIDPAIR["RXM-RAW"] and decoder.count(le) is not None]
+    return gather_blocks(buf, frames, decoder)
+
+def decode_file_observations(path, start=None, end=None):
+    """Like decode_observations() for a capture file, using its frame index.
+
+    See CaptureIndex.select() for start and end.
+    """
+    if numpy is None:
+        raise ImportError("decode_file_observations requires NumPy")
+    decoder = DECODERS[(CLIDPAIR["RXM-RAW"], None)]
+    frames = [(r[0], r[3]) for r in load_index(path).select(["RXM-RAW"], start, end)
+              if decoder.count(r[3]) is not None]
+    if not frames:
+        return gather_blocks(b"", frames, decoder)
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return gather_blocks(m, frames, decoder)
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def write_table(f, table, columns=None, fmt=None, sep=",", header=True, chunk=65536):
+    """Writes the columns of a structured array as text lines.
+
+    By default the columns are separated by sep and preceded by a line with
+    their names, and floats are written with full precision. fmt, if given,
+    is a % format for a tuple of the columns of one row and replaces sep and
+    the header.
+    """
+    if columns is None:
+        columns = table.dtype.names
+    if fmt is None:
+        if header:
+            f.write(sep.join(columns) + "\n")
+        fmt = sep.join(["%r" if table.dtype[name].kind == "f" else "%s" for name in columns])
+    fmt += "\n"
+    view = table[list(columns)]
+    for i in xrange(0, len(view), chunk):
+        f.write("".join([fmt % row for row in view[i:i + chunk].tolist()]))
+
+def is_poll(clid, length):
+    """Returns whether a message of type clid with a payload of length bytes
+    polls the receiver rather than setting something.
+
+    Polls have no payload, or a fixed format payload that is shorter than
+    the full message, such as the PortID of CFG-PRT.
+    """
+    if length == 0:
+        return True
+    lengths = [le for (name, le) in MSGFMT if name == clid]
+    return length in lengths and (None in lengths or length < max(lengths))
+
+class Request():
+    """A message sent with Parser.request() and the answer it waits for.
+
+    expect is "reply" for polls, which are answered with a message of the
+    same type, or "ack" for messages answered with ACK-ACK/ACK-NACK. By
+    default CFG messages that are not polls, see is_poll(), expect "ack". Once
+    done, status is "reply", "ack", "nack" or "timeout" and data holds the
+    decoded answer, if any, and callback(request) has been called.
+    """
+    def __init__(self, clid, length, payload, callback=None, expect=None, timeout=1.0, retries=2):
+        self.clid = clid
+        self.key = CLIDPAIR[clid]
+        self.length = length
+        self.payload = payload
+        self.callback = callback
+        if expect is None:
+            expect = "ack" if self.key[0] == CLASS["CFG"] and not is_poll(clid, length) else "reply"
+        self.expect = expect
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = None
+        self.status = None
+        self.data = None
+
+    def done(self):
+        return self.status is not None
+
+    def complete(self, status, data=None):
+        self.status = status
+        self.data = data
+        if self.callback is not None:
+            self.callback(self)
+
+class RequestTracker():
+    """Matches incoming messages to outstanding requests.
+
+    Requests are kept per (class, id) in the order they were sent. A message
+    completes the oldest request of its type waiting for a reply, and
+    ACK-ACK/ACK-NACK the oldest one for the type given by their ClsID and
+    MsgID. ACK-NACK also fails polls, ACK-ACK that follows a poll reply is
+    ignored.
+    """
+    def __init__(self):
+        self.outstanding = {}
+
+    def __len__(self):
+        return sum(len(requests) for requests in self.outstanding.values())
+
+    def add(self, request, now):
+        request.deadline = now + request.timeout
+        self.outstanding.setdefault(request.key, []).append(request)
+
+    def remove(self, request):
+        requests = self.outstanding[request.key]
+        requests.remove(request)
+        if not requests:
+            del self.outstanding[request.key]
+
+    def find(self, key, expect):
+        for request in self.outstanding.get(key, ()):
+            if expect is None or request.expect == expect:
+                return request
+        return None
+
+    def dispatch(self, cl, id, data):
+        if (cl, id) in (CLIDPAIR["ACK-ACK"], CLIDPAIR["ACK-NACK"]):
+            key = (data[0]["ClsID"], data[0]["MsgID"])
+            if id == CLIDPAIR["ACK-ACK"][1]:
+                request = self.find(key, "ack")
+                status = "ack"
+            else:
+                request = self.find(key, None)
+                status = "nack"
+        else:
+            request = self.find((cl, id), "reply")
+            status = "reply"
+        if request is not None:
+            self.remove(request)
+            request.complete(status, data)
+
+    def expired(self, now):
+        """Returns the outstanding requests whose deadline has passed."""
+        return [request for requests in self.outstanding.values() for request in requests
+                if request.deadline <= now]
+
+class Transaction():
+    """A batch of configuration messages sent with Parser.configure().
+
+    At most window messages are unacknowledged at any time; the receiver
+    processes them in order, so the batch needs a round trip per window
+    rather than per message. requests holds one Request per message, in
+    order, whose status tells whether it was acknowledged. With save set
+    to a saveMask, a CFG-CFG saving it follows once every message has been
+    acknowledged; otherwise its request is completed as "skipped".
+    callback(transaction) is called when all are done.
+    """
+    def __init__(self, parser, messages, callback=None, window=4, save=None, timeout=1.0, retries=2):
+        self.parser = parser
+        self.messages = list(messages)
+        if save is not None:
+            self.messages.append(("CFG-CFG", 12, {"clearMask": 0, "saveMask": save, "loadMask": 0}))
+        self.callback = callback
+        self.window = window
+        self.save = save
+        self.timeout = timeout
+        self.retries = retries
+        self.requests = []
+        self.pending = 0
+
+    def start(self):
+        self.sendMore()
+
+    def sendMore(self):
+        while self.pending < self.window and len(self.requests) < len(self.messages):
+            (clid, length, payload) = self.messages[len(self.requests)]
+            if clid == "CFG-CFG" and self.save is not None and len(self.requests) == len(self.messages) - 1:
+                if self.pending > 0:
+                    return
+                if self.failed():
+                    self.requests.append(Request(clid, length, payload, expect="ack"))
+                    self.requests[-1].complete("skipped")
+                    break
+            self.pending += 1
+            self.requests.append(self.parser.request(clid, length, payload, self.cbRequestDone,
+                                                     "ack", self.timeout, self.retries))
+        if self.done() and self.callback is not None:
+            self.callback(self)
+
+    def cbRequestDone(self, request):
+        self.pending -= 1
+        self.sendMore()
+
+    def done(self):
+        return len(self.requests) == len(self.messages) and self.pending == 0
+
+    def failed(self):
+        """Returns the requests that have not been acknowledged."""
+        return [request for request in self.requests if request.done() and request.status != "ack"]
+
+class MemoryTransfer():
+    """Base of the pipelined UPD-UPLOAD and UPD-DOWNL transfers.
+
+    Up to window requests of chunk bytes are in flight at once and are
+    matched to their replies by StartAddr, so replies may arrive in any
+    order. A request that is not answered within timeout seconds is sent
+    again up to retries times; if no request of the current chunk size has
+    been answered yet, it is split in halves instead, until the receiver
+    accepts the size. Chunks that still fail are listed in self.failed.
+    callback(transfer) is called once every chunk is done.
+
+    Subclasses set clid and implement payload() and received().
+    """
+    clid = None
+
+    def __init__(self, parser, start, chunk, window, timeout, retries, callback):
+        self.parser = parser
+        self.start = start
+        self.chunk = chunk
+        self.proven = False
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.callback = callback
+        self.queue = []
+        self.outstanding = {}
+        self.finished = False
+        self.failed = []
+        self.bytes = 0
+        self.started = None
+
+    def split(self, ranges):
+        """Queues ranges before the queued ones, all in pieces of self.chunk."""
+        chunk = self.chunk
+        ranges = ranges + self.queue[::-1]
+        self.queue = [(a, min(chunk, address + size - a)) for (address, size) in ranges
+                      for a in xrange(address, address + size, chunk)]
+        self.queue.reverse()
+
+    def run(self):
+        """Starts the transfer; the parser's event loop completes it."""
+        self.started = time.time()
+        self.parser.subscribe(self.clid, self.cbReply)
+        self.sendMore()
+
+    def sendMore(self):
+        while self.queue and len(self.outstanding) < self.window:
+            (address, size) = self.queue.pop()
+            self.send(address, size, self.retries)
+        if not self.queue and not self.outstanding and not self.finished:
+            self.finished = True
+            self.parser.unsubscribe(self.clid, self.cbReply)
+            self.finish()
+
+    def finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def send(self, address, size, retries):
+        self.outstanding[address] = (size, time.time() + self.timeout, retries)
+        self.parser.sendraw(build_frame(self.clid, self.payload(address, size)))
+        self.parser.addTimeout(self.timeout, self.cbTimeout)
+
+    def cbReply(self, ty, data):
+        header = data[0]
+        address = header["StartAddr"]
+        if header["Flags"] != 1 or address not in self.outstanding:
+            return
+        (size, deadline, retries) = self.outstanding.pop(address)
+        n = self.received(header, address, size)
+        if n < size:
+            self.split([(address + n, size - n)])
+        if n == self.chunk:
+            self.proven = True
+        self.bytes += n
+        self.sendMore()
+
+    def cbTimeout(self):
+        now = time.time()
+        for (address, (size, deadline, retries)) in list(self.outstanding.items()):
+            if deadline > now:
+                continue
+            del self.outstanding[address]
+            if not self.proven and size > 1:
+                if size <= self.chunk:
+                    self.chunk = (size + 1) // 2
+                self.split([(address, size)])
+            elif retries > 0:
+                self.send(address, size, retries - 1)
+            else:
+                self.failed.append((address, size))
+        self.sendMore()
+        return False
+
+    def done(self):
+        return not self.queue and not self.outstanding
+
+    def rate(self):
+        """Returns the bytes transferred per second since run()."""
+        elapsed = time.time() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+class MemoryDump(MemoryTransfer):
+    """Reads length bytes of receiver memory from start with UPD-UPLOAD.
+
+    out is a file opened for writing in binary mode; offset 0 corresponds to
+    start. With a checkpoint path, every completed chunk is appended to it
+    as "address size" and chunks already listed there are not read again.
+    See MemoryTransfer for the other arguments.
+    """
+    clid = "UPD-UPLOAD"
+
+    def __init__(self, parser, start, length, out, chunk=512, window=4, timeout=1.0, retries=3,
+                 checkpoint=None, callback=None):
+        MemoryTransfer.__init__(self, parser, start, chunk, window, timeout, retries, callback)
+        self.length = length
+        self.out = out
+        done = []
+        self.checkpoint = None
+        if checkpoint is not None:
+            if os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    done = sorted(tuple(int(x) for x in line.split()) for line in f if line.strip())
+            self.checkpoint = open(checkpoint, "a")
+        gaps = []
+        pos = start
+        for (address, size) in done + [(start + length, 0)]:
+            if address > pos:
+                gaps.append((pos, address - pos))
+            pos = max(pos, address + size)
+        self.split(gaps)
+
+    def payload(self, address, size):
+        return struct.pack("<III", address, size, 0) + b"\0" * size
+
+    def received(self, header, address, size):
+        # The data follows the header whichever MSGFMT entry decoded it
+        block = header.raw(12, 12 + min(size, header["DataSize"]))
+        self.out.seek(address - self.start)
+        self.out.write(block)
+        if self.checkpoint is not None:
+            self.out.flush()
+            self.checkpoint.write("%d %d\n" % (address, len(block)))
+            self.checkpoint.flush()
+        return len(block)
+
+    def finish(self):
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        MemoryTransfer.finish(self)
+
+class MemoryWrite(MemoryTransfer):
+    """Writes the bytes data to receiver memory at start with UPD-DOWNL.
+
+    With verify set, the written range is read back with a MemoryDump once
+    every chunk has been acknowledged, and the (address, size) ranges that
+    differ are listed in self.mismatches. See MemoryTransfer for the other
+    arguments.
+    """
+    clid = "UPD-DOWNL"
+
+    def __init__(self, parser, start, data, chunk=512, window=4, timeout=1.0, retries=3,
+                 verify=False, callback=None):
+        MemoryTransfer.__init__(self, parser, start, chunk, window, timeout, retries, callback)
+        self.data = data
+        self.verify = verify
+        self.readback = None
+        self.mismatches = []
+        self.split([(start, len(data))])
+
+    def payload(self, address, size):
+        offset = address - self.start
+        return struct.pack("<II", address, 0) + self.data[offset:offset + size]
+
+    def received(self, header, address, size):
+        return size
+
+    def finish(self):
+        if not self.verify:
+            MemoryTransfer.finish(self)
+            return
+        self.readback = io.BytesIO()
+        MemoryDump(self.parser, self.start, len(self.data), self.readback, self.chunk, self.window,
+                   self.timeout, self.retries, callback=self.cbVerified).run()
+
+    def cbVerified(self, dump):
+        self.failed.extend(dump.failed)
+        written = bytearray(self.data)
+        read = bytearray(self.readback.getvalue().ljust(len(written), b"\0"))
+        start = None
+        for i in xrange(len(written) + 1):
+            differs = i < len(written) and written[i] != read[i]
+            if differs and start is None:
+                start = i
+            elif not differs and start is not None:
+                self.mismatches.append((self.start + start, i - start))
+                start = None
+        MemoryTransfer.finish(self)
+
+class MemoryScan():
+    """Maps the readable regions of receiver memory with UPD-UPLOAD probes.
+
+    The addresses start, start + step, ... below end are probed first.
+    Between two neighbouring probes that disagree, the boundary is then
+    bisected down to resolution bytes, all boundaries at once. An address is
+    readable if a request for size bytes there is answered; it is unreadable
+    once retries + 1 requests timed out. Up to window requests are in flight.
+    Regions narrower than step can be missed.
+
+    callback(scan) is called when self.regions, a list of (start, end,
+    readable), is complete.
+    """
+    def __init__(self, parser, start=0, end=1 << 32, step=64 << 20, resolution=4, size=4, window=8,
+                 timeout=1.0, retries=1, callback=None):
+        self.parser = parser
+        self.start = start
+        self.end = end
+        self.step = step
+        self.resolution = resolution
+        self.size = size
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.callback = callback
+        self.probes = list(xrange(start, end, step))
+        self.results = {}
+        self.queue = self.probes[::-1]
+        self.outstanding = {}
+        self.bisections = None
+        self.boundaries = []
+        self.regions = None
+        self.requests = 0
+
+    def run(self):
+        """Starts the scan; the parser's event loop completes it."""
+        self.started = time.time()
+        self.parser.subscribe("UPD-UPLOAD", self.cbUpload)
+        self.sendMore()
+
+    def sendMore(self):
+        while self.queue and len(self.outstanding) < self.window:
+            self.send(self.queue.pop(), self.retries)
+        if self.queue or self.outstanding or self.regions is not None:
+            return
+        if self.bisections is None:
+            # All coarse probes are in, bisect where neighbours disagree
+            self.bisections = {}
+            for (lo, hi) in zip(self.probes, self.probes[1:]):
+                if self.results[lo] != self.results[hi]:
+                    self.bisect(lo, hi)
+            if self.queue:
+                self.sendMore()
+                return
+        self.finish()
+
+    def bisect(self, lo, hi):
+        if hi - lo <= self.resolution:
+            self.boundaries.append(hi)
+            return
+        mid = lo + max((hi - lo) // (2 * self.resolution), 1) * self.resolution
+        self.bisections[mid] = (lo, hi)
+        self.queue.append(mid)
+
+    def send(self, address, retries):
+        self.outstanding[address] = (time.time() + self.timeout, retries)
+        self.requests += 1
+        self.parser.sendraw(build_frame("UPD-UPLOAD", struct.pack("<III", address, self.size, 0) + b"\0" * self.size))
+        self.parser.addTimeout(self.timeout, self.cbTimeout)
+
+    def cbUpload(self, ty, data):
+        address = data[0]["StartAddr"]
+        if data[0]["Flags"] == 1 and address in self.outstanding:
+            del self.outstanding[address]
+            self.result(address, True)
+            self.sendMore()
+
+    def cbTimeout(self):
+        now = time.time()
+        for (address, (deadline, retries)) in list(self.outstanding.items()):
+            if deadline > now:
+                continue
+            del self.outstanding[address]
+            if retries > 0:
+                self.send(address, retries - 1)
+            else:
+                self.result(address, False)
+        self.sendMore()
+        return False
+
+    def result(self, address, readable):
+        self.results[address] = readable
+        if self.bisections and address in self.bisections:
+            (lo, hi) = self.bisections.pop(address)
+            if readable == self.results[lo]:
+                self.bisect(address, hi)
+            else:
+                self.bisect(lo, address)
+
+    def finish(self):
+        self.parser.unsubscribe("UPD-UPLOAD", self.cbUpload)
+        self.regions = []
+        if self.probes:
+            start = self.start
+            readable = self.results[start]
+            for boundary in sorted(self.boundaries):
+                self.regions.append((start, boundary, readable))
+                (start, readable) = (boundary, not readable)
+            self.regions.append((start, self.end, readable))
+        if self.callback is not None:
+            self.callback(self)
+
+class Recorder():
+    """Writes raw chunks to a file from a background thread.
+
+    write() can be used as rawCallback. It never blocks: if maxChunks chunks
+    are already queued the chunk is dropped and counted in self.stats. The
+    writer thread joins what is queued into writes of up to coalesce bytes,
+    and fsyncs once syncBytes bytes have been written or syncInterval
+    seconds have passed since the last fsync. After a write error the
+    exception is kept in self.error and further chunks are dropped.
+    Both threads update self.stats, always holding self.lock.
+    """
+    def __init__(self, f, maxChunks=1024, coalesce=1 << 20, syncInterval=5.0, syncBytes=4 << 20):
+        self.f = f
+        self.coalesce = coalesce
+        self.syncInterval = syncInterval
+        self.syncBytes = syncBytes
+        self.queue = queue.Queue(maxChunks)
+        self.error = None
+        self.stats = {"chunks": 0, "bytes": 0, "dropped": 0, "dropped_bytes": 0, "writes": 0, "syncs": 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except queue.Full:
+                pass
+        self.count(dropped=1, dropped_bytes=len(data))
+
+    def count(self, **counts):
+        with self.lock:
+            for (key, n) in counts.items():
+                self.stats[key] += n
+
+    def close(self):
+        """Writes what is queued, fsyncs and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        unsynced = 0
+        synced = time.time()
+        stop = False
+        while not stop:
+            timeout = max(synced + self.syncInterval - time.time(), 0.01)
+            try:
+                chunks = [self.queue.get(True, timeout)]
+            except queue.Empty:
+                chunks = []
+            size = sum(len(chunk) for chunk in chunks if chunk is not None)
+            while size < self.coalesce and chunks and chunks[-1] is not None:
+                try:
+                    chunk = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                chunks.append(chunk)
+                if chunk is not None:
+                    size += len(chunk)
+            if chunks and chunks[-1] is None:
+                chunks.pop()
+                stop = True
+            if self.error is not None:
+                self.count(dropped=len(chunks), dropped_bytes=size)
+                continue
+            try:
+                if chunks:
+                    self.f.write(b"".join(chunks))
+                    self.count(chunks=len(chunks), bytes=size, writes=1)
+                    unsynced += size
+                if unsynced and (stop or unsynced >= self.syncBytes or time.time() - synced >= self.syncInterval):
+                    self.f.flush()
+                    os.fsync(self.f.fileno())
+                    self.count(syncs=1)
+                    unsynced = 0
+                    synced = time.time()
+            except (IOError, OSError) as e:
+                logging.error("cannot write raw data: %s" % e)
+                self.error = e
+                self.count(dropped=len(chunks), dropped_bytes=size)
+
+# Linux speeds that termios of older Pythons does not define
+LINUX_SPEEDS = {230400: 0o010003, 460800: 0o010004, 500000: 0o010005, 576000: 0o010006,
+                921600: 0o010007}
+
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+
+def configure_tty(fd, baudrate=None, low_latency=False):
+    """Puts the serial device fd in raw mode and discards pending input.
+
+    Equivalent to stty raw, without starting a process. VMIN and VTIME are
+    left alone as the parser reads the device without blocking. low_latency
+    asks the serial driver to deliver bytes as soon as they arrive; returns
+    whether the driver agreed.
+    """
+    (iflag, oflag, cflag, lflag, ispeed, ospeed, cc) = termios.tcgetattr(fd)
+    iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR |
+               termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY)
+    oflag &= ~termios.OPOST
+    lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+    cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+    if baudrate is not None:
+        ispeed = ospeed = getattr(termios, "B%d" % baudrate, None) or LINUX_SPEEDS[baudrate]
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+    termios.tcflush(fd, termios.TCIFLUSH)
+    if not low_latency:
+        return False
+    # struct serial_struct, flags is its fifth int
+    serial = array.array("B", [0] * 128)
+    try:
+        fcntl.ioctl(fd, TIOCGSERIAL, serial)
+        (flags,) = struct.unpack_from("i", serial, 16)
+        struct.pack_into("i", serial, 16, flags | ASYNC_LOW_LATENCY)
+        fcntl.ioctl(fd, TIOCSSERIAL, serial)
+    except IOError as e:
+        logging.debug("low latency not supported: %s" % e)
+        return False
+    return True
+
 class Parser():
-    def __init__(self, callback, rawCallback=None, device="/dev/ttyACM0"):
+    def __init__(self, callback, rawCallback=None, device="/dev/ttyACM0", watch=True,
+                 readSize=4096, readMax=65536, baudrate=None, lowLatency=False):
+        """Opens device, unless it is false, and feeds what it reads to parse().
+
+        With watch set the device is read from the GLib main loop. Other event
+        loops pass watch=False and call cbDeviceReadable() themselves.
+
+        Each wakeup reads at least readSize bytes, more if the device reports
+        more pending, up to readMax, into a buffer that is reused. The device
+        is set up with configure_tty(), see there for baudrate and lowLatency.
+        """
         self.callback = callback
         self.rawCallback = rawCallback
         self.device = device
+        self.readMax = readMax
+        self.rbuf = bytearray(min(readSize, readMax))
         if device:
-            os.system("stty -F %s raw" % device)
-            self.fd = os.open(device, os.O_NONBLOCK | os.O_RDWR)
-            try:
-                buf = os.read(self.fd, 512) # flush input
-                logging.debug("flushed %s" % repr(buf))
-            except:
-                pass
-            gobject.io_add_watch(self.fd, gobject.IO_IN, self.cbDeviceReadable)
-        self.buffer = ""
-        self.ack = {"CFG-PRT" : 0}
+            self.fd = os.open(device, os.O_NONBLOCK | os.O_RDWR | os.O_NOCTTY)
+            self.reader = io.FileIO(self.fd, "r", closefd=False)
+            if fcntl is not None:
+                try:
+                    configure_tty(self.fd, baudrate, low_latency=lowLatency)
+                except termios.error as e:
+                    logging.warning("cannot set up %s: %s" % (device, e))
+            if watch:
+                if gobject is None:
+                    raise ImportError("gobject is required to watch %s, use watch=False" % device)
+                gobject.io_add_watch(self.fd, gobject.IO_IN, self.cbDeviceReadable)
+        self.framer = Framer()
+        self.handlers = {}
+        self.requests = RequestTracker()
         self.ubx = {}
 
+    def subscribe(self, clid, handler):
+        """Calls handler(ty, data) for every message of type clid.
+
+        clid is a message name or a (class, id) pair. Messages that neither
+        have a handler nor a callback are framed but never decoded.
+        """
+        self.handlers.setdefault(CLIDPAIR.get(clid, clid), []).append(handler)
+
+    def unsubscribe(self, clid, handler):
+        clid = CLIDPAIR.get(clid, clid)
+        self.handlers[clid].remove(handler)
+        if not self.handlers[clid]:
+            del self.handlers[clid]
+
     def cbDeviceReadable(self, source, condition):
-        data = os.read(source, 512)
-        #print("read %s" % repr(data))
+        available = self.available()
+        if available > len(self.rbuf) and len(self.rbuf) < self.readMax:
+            self.rbuf = bytearray(min(available, self.readMax))
+        n = self.reader.readinto(self.rbuf)
+        if n is None:
+            # Nothing to read after all
+            return True
+        if n == 0:
+            # Hangup, such as an unplugged USB receiver
+            logging.error("%s: device closed" % self.device)
+            return False
         if self.rawCallback:
-            self.rawCallback(data)
-        self.parse(data)
+            self.rawCallback(memoryview(self.rbuf)[:n].tobytes())
+        self.parse(self.rbuf, n)
         return True
 
-    def parse( self, data):
-        self.buffer += data
-        buffer_offset = 0
-        # Minimum packet length is 8
-        while len(self.buffer) >= buffer_offset + 8:
-            # Find the beginning of a UBX message
-            start = self.buffer.find( chr( SYNC1 ) + chr( SYNC2 ), buffer_offset )
-
-            if buffer_offset == 0 and start != 0:
-                #logging.debug( "Discarded data not UBX %s" % repr(self.buffer[:start]) )
-                self.buffer = self.buffer[start:]
-                continue
-
-            if start == -1 or start + 8 > len(self.buffer):
-                return True
+    def available(self):
+        """Returns how many bytes the device has ready to read, or 0 if unknown."""
+        if fcntl is None:
+            return 0
+        try:
+            return struct.unpack("i", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+        except IOError:
+            return 0
 
-            (cl, id, length) = struct.unpack("<BBH", self.buffer[start+2:start+6])
-            if len(self.buffer) < start + length + 8:
-                buffer_offset = start + 2
-                continue
+    def parse( self, data, end=None):
+        for (buf, start, cl, id, length) in self.framer.frames(data, end):
+            if self.callback is not None or (cl, id) in self.handlers or self.requests.outstanding:
+                self.decode(cl, id, length, buf, start + 6)
+        return True
 
-            if self.checksum(self.buffer[start+2:start+length+6]) != struct.unpack("<BB", self.buffer[start+length+6:start+length+8]):
-                buffer_offset = start + 2
-                continue
+    def parseStream(self, f, size=65536):
+        """Parses the file object f until its end, size bytes at a time.
 
-            if start != 0:
-                logging.warning(" UBX packet ignored %s" % repr(self.buffer[:start]) )
-                self.buffer = self.buffer[start:]
-                buffer_offset = 0
-                continue
+        Chunks are read into one reusable buffer, so memory use does not
+        depend on the length of the stream and messages are delivered as
+        they arrive, which suits pipes such as stdin.
+        """
+        f = getattr(f, "buffer", f) # binary stdin on Python 3
+        readinto = getattr(f, "readinto1", f.readinto)
+        buf = bytearray(size)
+        while True:
+            n = readinto(buf)
+            if not n:
+                break
+            self.parse(buf, n)
 
-            self.decode(cl, id, length, self.buffer[start+6:start+length+6])
+    def parseFile(self, path, types=None, start=None, end=None):
+        """Decodes the frames of a capture file selected through its index.
 
-            # Discard packet
-            self.buffer = self.buffer[start+length+8:]
-            buffer_offset = 0
+        See CaptureIndex.select() for the meaning of types, start and end.
+        """
+        records = load_index(path).select(types, start, end)
+        if not records:
+            return
+        f = open(path, 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for (offset, cl, id, length, week, itow) in records:
+                    if self.callback is not None or (cl, id) in self.handlers or self.requests.outstanding:
+                        self.decode(cl, id, length, m, offset + 6)
+            finally:
+                m.close()
+        finally:
+            f.close()
 
     def send( self, clid, length, payload ):
-        logging.debug( "Sending UBX packet of type %s: %s" % ( clid, payload ) )
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug( "Sending UBX packet of type %s: %s" % ( clid, payload ) )
 
         stream = struct.pack("<BBBBH", SYNC1, SYNC2, CLIDPAIR[clid][0], CLIDPAIR[clid][1], length)
         if length > 0:
@@ -438,56 +2046,86 @@ class Parser():
                 fmt_rep = format[3:]
                 payload_base = payload[0]
                 payload_rep = payload[1:]
-                if (length - fmt_base[0])%fmt_rep[0] != 0:
+                if fmt_rep[0] != 0 and (length - fmt_base[0])%fmt_rep[0] != 0:
                     logging.error( "Cannot send: Variable length message class \
                         0x%x, id 0x%x has wrong length %i" % ( cl, id, length ) )
                     return
             stream = stream + struct.pack(fmt_base[1], *[payload_base[i] for i in fmt_base[2]])
             if fmt_rep[0] != 0:
-                for i in range(0, (length - fmt_base[0])/fmt_rep[0]):
+                for i in range(0, (length - fmt_base[0])//fmt_rep[0]):
                     stream = stream + struct.pack(fmt_rep[1], *[payload_rep[i][j] for j in fmt_rep[2]])
+            elif length > fmt_base[0]:
+                # Formats without blocks are followed by the bytes payload[1]
+                stream = stream + payload_rep[0]
         stream = stream + struct.pack("<BB", *self.checksum( stream[2:] ))
         self.sendraw(stream)
 
+    def request(self, clid, length=0, payload=[], callback=None, expect=None, timeout=1.0, retries=2):
+        """Sends a message and tracks the reply or acknowledgement it expects.
+
+        Any number of requests may be in flight. A request that is not
+        answered within timeout seconds is sent again up to retries times,
+        then completed with status "timeout". See Request for callback and
+        expect. Returns the Request.
+        """
+        request = Request(clid, length, payload, callback, expect, timeout, retries)
+        self.send(clid, length, payload)
+        self.requests.add(request, time.time())
+        self.addTimeout(request.timeout, self.cbRequestTimeout)
+        return request
+
+    def configure(self, messages, callback=None, window=4, save=None, timeout=1.0, retries=2):
+        """Sends a list of (clid, length, payload) messages as a Transaction.
+
+        Each message is expected to be acknowledged. Returns the started
+        Transaction.
+        """
+        transaction = Transaction(self, messages, callback, window, save, timeout, retries)
+        transaction.start()
+        return transaction
+
+    def addTimeout(self, seconds, callback):
+        """Calls callback() after seconds from the event loop of the parser."""
+        gobject.timeout_add(int(seconds * 1000) + 1, callback)
+
+    def cbRequestTimeout(self):
+        now = time.time()
+        for request in self.requests.expired(now):
+            if request.retries > 0:
+                request.retries -= 1
+                request.deadline = now + request.timeout
+                self.send(request.clid, request.length, request.payload)
+                self.addTimeout(request.timeout, self.cbRequestTimeout)
+            else:
+                self.requests.remove(request)
+                request.complete("timeout")
+        return False
+
     def sendraw(self, data):
         #print("write %s" % repr(data))
         #print("echo -en \"%s\" > /dev/ttySAC1" % "".join(["\\x%02x" % ord(x) for x in data]))
         os.write(self.fd, data)
 
     def checksum( self, msg ):
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + ord(i)
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
-
-    def decode( self, cl, id, length, payload ):
-        data = []
-        try:
-            format = MSGFMT_INV[((cl, id), length)]
-            data.append(dict(zip(format[1], struct.unpack(format[0], payload))))
-        except KeyError:
-            try:
-                # Try if this is one of the variable field messages
-                format = MSGFMT_INV[((cl, id), None)]
-                fmt_base = format[:3]
-                fmt_rep = format[3:]
-                # Check if the length matches
-                if (length - fmt_base[0])%fmt_rep[0] != 0:
-                    logging.error( "Variable length message class 0x%x, id 0x%x \
-                        has wrong length %i" % ( cl, id, length ) )
-                    return
-                data.append(dict(zip(fmt_base[2], struct.unpack(fmt_base[1], payload[:fmt_base[0]]))))
-                for i in range(0, (length - fmt_base[0])/fmt_rep[0]):
-                    offset = fmt_base[0] + fmt_rep[0] * i
-                    data.append(dict(zip(fmt_rep[2], struct.unpack(fmt_rep[1], payload[offset:offset+fmt_rep[0]]))))
+        return checksum(msg)
 
-            except KeyError:
-                logging.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
-                return
+    def decode( self, cl, id, length, payload, offset=0 ):
+        decoder = get_decoder(cl, id, length)
+        if decoder is None:
+            logging.info( "Unknown message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            return
+        if decoder.count(length) is None:
+            logging.error( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            return
+        # Messages unpack lazily, so they get their own copy of the payload
+        data = decoder.decode(length, bytes(payload[offset:offset + length]))
 
-        logging.debug( "Got UBX packet of type %s: %s" % (format[-1] , data ) )
-        self.callback(format[-1], data)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug( "Got UBX packet of type %s: %s" % (decoder.clid , data ) )
+        if self.requests.outstanding:
+            self.requests.dispatch(cl, id, data)
+        for handler in self.handlers.get((cl, id), ()):
+            handler(decoder.clid, data)
+        if self.callback is not None:
+            self.callback(decoder.clid, data)
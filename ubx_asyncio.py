@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""
+asyncio backend for the UBX parser
+
+Runs a ubx.Parser on an asyncio event loop instead of the GLib main loop.
+Requires Python 3.6 or later.
+
+    parser = AsyncParser(device="/dev/ttyACM0")
+    ports = await parser.requestAsync("CFG-PRT")
+    async for data in parser.messages("RXM-RAW"):
+        ...
+
+GPLv2
+"""
+import asyncio
+import os
+
+import ubx
+
+class RequestError(Exception):
+    pass
+
+class AsyncParser(ubx.Parser):
+    """Parser that reads and writes its device from an asyncio event loop.
+
+    Writes never block: what the device does not accept is buffered and
+    flushed when it becomes writable, and drain() waits for the buffer to
+    fall below writeLimit bytes. Reading pauses while a messages() consumer
+    lags more than queueSize messages behind. requestAsync() and
+    configureAsync() await what ubx.Parser.request() and configure() pass to
+    their callback; these keep their interface, so code written for
+    ubx.Parser still works.
+    """
+    def __init__(self, callback=None, rawCallback=None, device="/dev/ttyACM0", loop=None,
+                 queueSize=64, writeLimit=4096):
+        ubx.Parser.__init__(self, callback, rawCallback, device, watch=False)
+        self.loop = loop or asyncio.get_event_loop()
+        self.queueSize = queueSize
+        self.writeLimit = writeLimit
+        self.wbuf = bytearray()
+        self.drainWaiters = []
+        self.queues = []
+        self.paused = False
+        self.loop.add_reader(self.fd, self.cbDeviceReadable, self.fd, None)
+
+    def close(self):
+        if not self.paused:
+            self.loop.remove_reader(self.fd)
+        if self.wbuf:
+            self.loop.remove_writer(self.fd)
+        os.close(self.fd)
+
+    def pause(self):
+        if not self.paused:
+            self.loop.remove_reader(self.fd)
+            self.paused = True
+
+    def resume(self):
+        if self.paused and all(q.qsize() < self.queueSize for q in self.queues):
+            self.loop.add_reader(self.fd, self.cbDeviceReadable, self.fd, None)
+            self.paused = False
+
+    def sendraw(self, data):
+        if not self.wbuf:
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                n = 0
+            if n == len(data):
+                return
+            data = data[n:]
+            self.loop.add_writer(self.fd, self.cbDeviceWritable)
+        self.wbuf += data
+
+    def cbDeviceWritable(self):
+        try:
+            n = os.write(self.fd, self.wbuf)
+        except BlockingIOError:
+            return
+        del self.wbuf[:n]
+        if not self.wbuf:
+            self.loop.remove_writer(self.fd)
+        if len(self.wbuf) <= self.writeLimit:
+            waiters, self.drainWaiters = self.drainWaiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def drain(self):
+        """Waits until no more than writeLimit bytes are waiting to be written."""
+        while len(self.wbuf) > self.writeLimit:
+            waiter = self.loop.create_future()
+            self.drainWaiters.append(waiter)
+            await waiter
+
+    def addTimeout(self, seconds, callback):
+        self.loop.call_later(seconds, callback)
+
+    async def requestAsync(self, clid, length=0, payload=[], expect=None, timeout=1.0, retries=2):
+        """Sends a message and returns the data of its reply or acknowledgement.
+
+        With the default empty payload this polls clid. Several requests may
+        be awaited concurrently, see ubx.Parser.request(). Raises
+        asyncio.TimeoutError if no answer arrives after the retries, and
+        RequestError if the receiver answers with ACK-NACK.
+        """
+        done = self.loop.create_future()
+        self.request(clid, length, payload, lambda r: done.done() or done.set_result(r),
+                     expect, timeout, retries)
+        await self.drain()
+        request = await done
+        if request.status == "timeout":
+            raise asyncio.TimeoutError("no answer to %s" % clid)
+        if request.status == "nack":
+            raise RequestError("%s was not acknowledged" % clid)
+        return request.data
+
+    async def configureAsync(self, messages, window=4, save=None, timeout=1.0, retries=2):
+        """Sends messages as a ubx.Transaction and returns it once it is done."""
+        done = self.loop.create_future()
+        self.configure(messages, lambda t: done.done() or done.set_result(t),
+                       window, save, timeout, retries)
+        await self.drain()
+        return await done
+
+    async def messages(self, clid):
+        """Yields the data of every message of type clid as it arrives."""
+        queue = asyncio.Queue()
+        def handler(ty, data):
+            queue.put_nowait(data)
+            if queue.qsize() >= self.queueSize:
+                self.pause()
+        self.queues.append(queue)
+        self.subscribe(clid, handler)
+        try:
+            while True:
+                data = await queue.get()
+                self.resume()
+                yield data
+        finally:
+            self.unsubscribe(clid, handler)
+            self.queues.remove(queue)
+            self.resume()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+"""
+Multi-receiver daemon
+
+Reads any number of receivers in one process from a single selectors
+loop, with one Parser per device. Receivers are listed in a config file,
+one section each; the section name is the source every message is tagged
+with:
+
+    [station1]
+    device = /dev/ttyACM0
+    raw = /data/station1.ubx
+    types = RXM-RAW NAV-POSLLH
+
+raw, if given, is appended every byte read from the device by a
+ubx.Recorder. types restricts decoding to those messages, otherwise all
+are decoded.
+
+Requires Python 3.4 or later.
+
+GPLv2
+"""
+import configparser
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import sys
+import time
+
+import ubx
+
+class DeviceParser(ubx.Parser):
+    """Parser for one device of a Daemon, which runs its timeouts."""
+    def __init__(self, daemon, source, callback, rawCallback, device):
+        ubx.Parser.__init__(self, callback, rawCallback, device, watch=False)
+        self.daemon = daemon
+        self.source = source
+
+    def addTimeout(self, seconds, callback):
+        self.daemon.addTimeout(seconds, callback)
+
+class Daemon():
+    """Reads many devices from one selectors loop.
+
+    callback(source, ty, data) is called for every message decoded from
+    any device. A device that cannot be opened or read is closed and
+    opened again every reopen seconds.
+    """
+    def __init__(self, callback, reopen=5.0):
+        self.callback = callback
+        self.reopen = reopen
+        self.selector = selectors.DefaultSelector()
+        self.devices = {}
+        self.parsers = {}
+        self.timeouts = []
+        self.sequence = itertools.count()
+        self.running = False
+
+    def add(self, source, device, types=None, raw=None):
+        """Reads device and tags its messages with source.
+
+        types is a list of message names to decode, or None for all. raw is
+        a ubx.Recorder, or any object whose write() takes every byte read.
+        Returns the DeviceParser, or None if the device is not there yet.
+        """
+        self.devices[source] = (device, types, raw)
+        return self.open(source)
+
+    def open(self, source):
+        (device, types, raw) = self.devices[source]
+        def callback(ty, data):
+            self.callback(source, ty, data)
+        rawCallback = raw.write if raw is not None else None
+        try:
+            parser = DeviceParser(self, source, None if types else callback, rawCallback, device)
+        except OSError as e:
+            logging.error("%s: cannot open %s: %s" % (source, device, e))
+            self.addTimeout(self.reopen, lambda: self.reopenDevice(source))
+            return None
+        for ty in types or ():
+            parser.subscribe(ty, callback)
+        self.parsers[source] = parser
+        self.selector.register(parser.fd, selectors.EVENT_READ, parser)
+        logging.info("%s: reading %s" % (source, device))
+        return parser
+
+    def reopenDevice(self, source):
+        # open() schedules the next attempt itself if this one fails
+        self.open(source)
+        return False
+
+    def close(self, source):
+        parser = self.parsers.pop(source)
+        self.selector.unregister(parser.fd)
+        os.close(parser.fd)
+
+    def addTimeout(self, seconds, callback):
+        """Calls callback() after seconds, and again as long as it returns True."""
+        heapq.heappush(self.timeouts, (time.time() + seconds, next(self.sequence), seconds, callback))
+
+    def runTimeouts(self):
+        now = time.time()
+        while self.timeouts and self.timeouts[0][0] <= now:
+            (deadline, sequence, seconds, callback) = heapq.heappop(self.timeouts)
+            if callback():
+                self.addTimeout(seconds, callback)
+
+    def cbDeviceReadable(self, parser):
+        try:
+            if parser.cbDeviceReadable(parser.fd, None):
+                return
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error("%s: cannot read %s: %s" % (parser.source, parser.device, e))
+        self.close(parser.source)
+        self.addTimeout(self.reopen, lambda: self.reopenDevice(parser.source))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = None
+            if self.timeouts:
+                timeout = max(0, self.timeouts[0][0] - time.time())
+            for (key, events) in self.selector.select(timeout):
+                self.cbDeviceReadable(key.data)
+            self.runTimeouts()
+
+    def stop(self):
+        self.running = False
+
+def callback(source, ty, data):
+    sys.stdout.write("%s %s %s\n" % (source, ty, repr(data)))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Read many receivers from one process.")
+    parser.add_argument('config', help='Config file with one section per receiver')
+    parser.add_argument('--reopen', type=float, default=5.0, help='Seconds between attempts to reopen a failed device')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        sys.exit("Cannot read %s" % args.config)
+    daemon = Daemon(callback, args.reopen)
+    recorders = []
+    for source in config.sections():
+        section = config[source]
+        types = section.get("types")
+        raw = section.get("raw")
+        if raw:
+            recorders.append(ubx.Recorder(open(raw, "ab")))
+        daemon.add(source, section["device"], types.split() if types else None,
+                   recorders[-1] if raw else None)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for recorder in recorders:
+            recorder.close()
@@ -22,33 +22,45 @@
 # Upload firmware of GPS chip to file.
 
 import ubx
-import struct
-import calendar
 import os
 import gobject
 import logging
 import sys
-import socket
 import time
 
-d = {}
-
-f = open("upload.dat", "w+")
 loop = gobject.MainLoop()
 
-def callback(ty, *args):
-    global f
-    global t
-    print("callback %s %s" % (ty, repr(args)))
-    if ty == "UPD-UPLOAD" and args[0][0]["Flags"] == 1:
-        for i in xrange(16):
-            f.write(chr(args[0][0]["B%s" % i]))
-        f.flush()
-        time.sleep(0.1)
-        t.send("UPD-UPLOAD", 12 +16, {"StartAddr" : args[0][0]["StartAddr"] + 16, "DataSize" : 16, "Flags" : 0, "B0" : 0, "B1" : 0, "B2" : 0, "B3" : 0, "B4" : 0, "B5" : 0, "B6" : 0, "B7" : 0, "B8" : 0, "B9" : 0, "B10" : 0, "B11" : 0, "B12" : 0, "B13" : 0, "B14" : 0, "B15" : 0})
-        
+def cbDone(dump):
+    elapsed = max(time.time() - dump.started, 1e-9)
+    print("%d bytes in %.1f s, %.0f bytes/s, chunk %d" % (dump.bytes, elapsed, dump.rate(), dump.chunk))
+    for (address, size) in dump.failed:
+        print("failed to read %d bytes at 0x%x" % (size, address))
+    loop.quit()
+
+def cbProgress(dump):
+    sys.stderr.write("%d bytes, %.0f bytes/s\n" % (dump.bytes, dump.rate()))
+    return not dump.finished
+
 if __name__ == "__main__":
-    t = ubx.Parser(callback)
-    start = int(sys.argv[1])
-    t.send("UPD-UPLOAD", 12 + 16, {"StartAddr" : start, "DataSize" : 16, "Flags" : 0, "B0" : 0, "B1" : 0, "B2" : 0, "B3" : 0, "B4" : 0, "B5" : 0, "B6" : 0, "B7" : 0, "B8" : 0, "B9" : 0, "B10" : 0, "B11" : 0, "B12" : 0, "B13" : 0, "B14" : 0, "B15" : 0})
+    import argparse
+    parser = argparse.ArgumentParser(description="Dump receiver memory with UPD-UPLOAD.")
+    parser.add_argument('start', type=lambda x: int(x, 0), help='First address')
+    parser.add_argument('length', type=lambda x: int(x, 0), help='Number of bytes')
+    parser.add_argument('--output', '-o', default='upload.dat', help='Output file')
+    parser.add_argument('--device', '-d', default='/dev/ttyACM0')
+    parser.add_argument('--chunk', type=int, default=512, help='Bytes per request, halved until the receiver answers')
+    parser.add_argument('--window', type=int, default=4, help='Requests in flight')
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--checkpoint', '-c', help='Record completed chunks here and resume from it')
+    args = parser.parse_args()
+
+    t = ubx.Parser(None, device=args.device)
+    # Resuming writes into the existing output
+    f = open(args.output, "r+b" if args.checkpoint and os.path.exists(args.output) else "wb")
+    dump = ubx.MemoryDump(t, args.start, args.length, f, args.chunk, args.window, args.timeout,
+                          args.retries, args.checkpoint, cbDone)
+    dump.run()
+    gobject.timeout_add(5000, cbProgress, dump)
     loop.run()
+    f.close()